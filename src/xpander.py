@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 import sys
 import time
+from pathlib import Path
+from threading import Thread
 from xpander_py.server import Server
 from xpander_py.fs import Settings, Manager
 from xpander_py.service import Service
 from xpander_py.util import listWindows
-from xpander_py.context import PHRASES
+from xpander_py.watch import Watcher
+from xpander_py import trace
 if sys.platform.startswith('win32'):
 	from macpy import WinWindow
 
@@ -13,8 +16,15 @@ if sys.platform.startswith('win32'):
 Settings.load()
 Settings.save()
 manager = Manager()
-manager.load()
+if Settings.get('phrase_library'):
+	changes = manager.loadLibrary(Settings.getPath('phrase_library').expanduser())
+else:
+	changes = manager.loadIndex()
+indexed = bool(changes)
+if not indexed:
+	changes = manager.load()
 service = Service()
+watcher = None
 
 
 def mainHandler(msg):
@@ -28,57 +38,158 @@ def mainHandler(msg):
 		Server.send({'type': 'main', 'action': 'focus'})
 
 
+def applyChanges(changes, save=True):
+	for change in changes:
+		if change.old:
+			service.unregisterPhrase(change.old)
+	for change in changes:
+		if change.new:
+			service.registerPhrase(change.new)
+	if changes and save:
+		manager.saveIndex()
+		if Settings.get('phrase_library'):
+			manager.saveLibrary(
+				Settings.getPath('phrase_library').expanduser(), changes
+			)
+
+
+def watchHandler(paths):
+	with manager.lock:
+		changes = manager.updatePaths(paths)
+		applyChanges(changes)
+	if changes:
+		Server.send({
+			'type': 'phrase',
+			'action': 'reload',
+			**manager.summarize(changes),
+		})
+
+
+def startWatcher():
+	global watcher
+	if watcher and (
+		not Settings.getBool('watch_phrases') or watcher.root != str(manager.root)
+	):
+		watcher.stop()
+		watcher = None
+	if Settings.getBool('watch_phrases') and not watcher:
+		watcher = Watcher(manager.root, watchHandler)
+		watcher.start()
+
+
 def phraseHandler(msg):
 	if msg['action'] == 'fillin':
-		service.fillin(msg['phrase'])
+		service.fillin(msg['form'], msg.get('values'))
 	elif msg['action'] in {'edit', 'delete'}:
-		if msg['path'] in manager.phrases:
-			phrase = manager.phrases[msg['path']]
-			del manager.phrases[msg['path']]
-			if phrase.name in PHRASES:
-				del PHRASES[phrase.name]
-			service.unregisterPhrase(phrase)
-		if msg['action'] == 'edit':
-			phrase = manager.loadPhrase(
-				msg['path'],
-				Settings.getPath('phrase_dir').expanduser()
-			)
-			manager.phrases[msg['path']] = phrase
-			PHRASES[phrase.name] = phrase
-			service.registerPhrase(phrase)
+		with manager.lock:
+			if msg['action'] == 'edit':
+				change = manager.update(msg['path'], force=True)
+			else:
+				change = manager.remove(msg['path'])
+			if change:
+				applyChanges((change, ))
+	elif msg['action'] in {'bulkEdit', 'bulkDelete', 'import'}:
+		failed = skipped = ()
+		with manager.lock:
+			if msg['action'] == 'bulkEdit':
+				changes, failed = manager.updateMany(msg['paths'], force=True)
+			elif msg['action'] == 'bulkDelete':
+				changes = [
+					change for change in map(manager.remove, msg['paths']) if change
+				]
+			else:
+				changes, failed, skipped = manager.importPaths(
+					msg['paths'], msg.get('folder', ''), msg.get('overwrite', False)
+				)
+			applyChanges(changes)
+		Server.send({
+			'type': 'phrase',
+			'action': msg['action'],
+			**manager.summarize(changes),
+			'failed': failed,
+			'skipped': skipped,
+		})
+	elif msg['action'] == 'exportLibrary':
+		with manager.lock:
+			count = manager.saveLibrary(Path(msg['path']))
+		Server.send({
+			'type': 'phrase',
+			'action': 'exportLibrary',
+			'path': msg['path'],
+			'count': count,
+		})
 	elif msg['action'] == 'reload':
-		for phrase in manager.phrases.values():
-			service.unregisterPhrase(phrase)
-			if phrase.name in PHRASES:
-				del PHRASES[phrase.name]
-		manager.phrases = {}
-		manager.load()
-		for phrase in manager.phrases.values():
-			service.registerPhrase(phrase)
+		with manager.lock:
+			changes = manager.load()
+			applyChanges(changes)
+		Server.send({
+			'type': 'phrase',
+			'action': 'reload',
+			**manager.summarize(changes),
+		})
 
 
 def managerHandler(msg):
 	if msg['action'] == 'listWindows':
 		listWindows()
+	elif msg['action'] == 'clipboardStats':
+		Server.send({
+			'type': 'manager',
+			'action': 'clipboardStats',
+			'stats': service.output.timing.stats(),
+		})
+	elif msg['action'] == 'outputStats':
+		Server.send({
+			'type': 'manager',
+			'action': 'outputStats',
+			'stats': service.output.throughput.stats(),
+		})
+	elif msg['action'] == 'queueDepth':
+		Server.send({
+			'type': 'manager',
+			'action': 'queueDepth',
+			'depth': service.depth(),
+		})
+
+
+def traceHandler(msg):
+	if msg['action'] == 'list':
+		Server.send({
+			'type': 'trace',
+			'action': 'list',
+			'traces': trace.traces(),
+		})
+	elif msg['action'] == 'clear':
+		trace.clear()
 
 
 def settingsHandler(msg):
 	if msg['action'] == 'reload':
 		Settings.load()
+		service.configure()
 		service.unregisterHotkeys()
 		service.registerHotkeys()
 		phraseHandler({
 			'type': 'phrase',
 			'action': 'reload',
 		})
+		startWatcher()
 
 
-for filepath, phrase in manager.phrases.items():
-	service.registerPhrase(phrase)
+applyChanges(changes, save=not indexed)
 service.registerHotkeys()
 service.start()
+if indexed:
+	# Phrases were registered from the index, verify it against the disk
+	Thread(
+		target=phraseHandler,
+		args=({'type': 'phrase', 'action': 'reload'}, ),
+		daemon=True,
+	).start()
+startWatcher()
 Server.listen('main', mainHandler)
 Server.listen('phrase', phraseHandler)
 Server.listen('manager', managerHandler)
 Server.listen('settings', settingsHandler)
+Server.listen('trace', traceHandler)
 Server.start()
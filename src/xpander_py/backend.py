@@ -0,0 +1,409 @@
+import sys
+import time
+from threading import Thread, Event, Lock, local
+from macpy import Keyboard, Pointer, Window, HotKey, HotString
+from macpy import WindowEvent, WindowEventType
+from macpy import PLATFORM, Platform
+from klembord import Selection
+if sys.platform.startswith('win32'):
+	from ctypes import windll
+
+
+# Clipboard snapshot of the expansion being rendered on this thread
+CURRENT = local()
+
+class Backend(object):
+	current = None
+
+	@classmethod
+	def get(cls):
+		if cls.current is None:
+			cls.current = MacpyBackend()
+		return cls.current
+
+	@classmethod
+	def use(cls, backend):
+		cls.current = backend
+
+
+def windowId(window):
+	# macpy windows only hash by their native id, they don't compare equal
+	return hash(getattr(window, '_window', window)) if window is not None else None
+
+
+class WindowCache(object):
+
+	def __init__(self, backend, ttl=0.5):
+		super().__init__()
+		self.backend = backend
+		self.ttl = ttl
+		self.hooked = False
+		self.lock = Lock()
+		self.window = None
+		self.wmClass = None
+		self.title = None
+		self.fetched = None
+		self.titled = None
+		self.onFocus = None
+		self.stopped = Event()
+		self.poller = None
+
+	def start(self):
+		self.hooked = self.backend.installWindowHook(self.callback)
+		if not self.hooked and self.onFocus:
+			# Without focus events, notice changes about when they happen
+			# rather than only when an expansion asks for the window
+			self.stopped.clear()
+			self.poller = Thread(target=self.poll, name='xpander windows', daemon=True)
+			self.poller.start()
+
+	def stop(self):
+		if self.hooked:
+			self.backend.uninstallWindowHook()
+			self.hooked = False
+		self.stopped.set()
+		if self.poller is not None:
+			self.poller.join()
+			self.poller = None
+
+	def poll(self):
+		while not self.stopped.wait(self.ttl or 0.5):
+			try:
+				self.active()
+			except Exception:
+				# Windows can vanish while being read, try again next time
+				pass
+
+	def callback(self, event):
+		if event.type is WindowEventType.FOCUSED:
+			previous = self.set(event.window)[0]
+			if self.onFocus and windowId(event.window) != windowId(previous):
+				self.onFocus(event.window)
+		elif event.type is WindowEventType.DESTROYED:
+			with self.lock:
+				self.fetched = None
+
+	def set(self, window):
+		now = time.monotonic()
+		wmClass = window.wm_class if window else None
+		with self.lock:
+			previous, fetched = self.window, self.fetched
+			self.window = window
+			self.wmClass = wmClass
+			self.title = None
+			self.fetched = now
+			self.titled = None
+		return previous, fetched
+
+	def stale(self, stamp):
+		return stamp is None or time.monotonic() - stamp > self.ttl
+
+	def active(self):
+		# Focus events keep the window current, poll only without them
+		if self.fetched is None or (not self.hooked and self.stale(self.fetched)):
+			window = self.backend.activeWindow()
+			previous, fetched = self.set(window)
+			# The very first fetch isn't a change of focus
+			known = previous is not None or fetched is not None
+			if self.onFocus and known and windowId(window) != windowId(previous):
+				self.onFocus(window)
+		return self.window
+
+	def activeClass(self):
+		self.active()
+		return self.wmClass
+
+	def activeTitle(self):
+		window = self.active()
+		if window is None:
+			return None
+		# Titles change without a focus change, e.g. switching browser tabs
+		if self.stale(self.titled):
+			title = window.title
+			with self.lock:
+				if self.window is window:
+					self.title = title
+					self.titled = time.monotonic()
+			return title
+		return self.title
+
+
+class SelectionCache(object):
+
+	def __init__(self, backend):
+		super().__init__()
+		self.backend = backend
+		self.lock = Lock()
+		self.contents = {}
+		self.stats = {'reads': 0, 'hits': 0}
+
+	def get(self, name='CLIPBOARD'):
+		# Contents are only fetched again once the change sequence moves
+		sequence = self.backend.selectionSequence(name)
+		if sequence is not None:
+			with self.lock:
+				entry = self.contents.get(name)
+				if entry is not None and entry[0] == sequence:
+					self.stats['hits'] += 1
+					return entry[1]
+		text, html = self.backend.selection(name).get_with_rich_text()
+		content = (text.replace('\x00', '') if text else '', html or None)
+		with self.lock:
+			self.stats['reads'] += 1
+			if sequence is not None:
+				self.contents[name] = (sequence, content)
+		return content
+
+	def set(self, name, text, html=None):
+		selection = self.backend.selection(name)
+		if html is None:
+			selection.set_text(text)
+		else:
+			selection.set_with_rich_text(text, html)
+		sequence = self.backend.selectionSequence(name)
+		with self.lock:
+			if sequence is not None:
+				self.contents[name] = (sequence, (text, html))
+			else:
+				self.contents.pop(name, None)
+
+
+class Snapshot(object):
+	# Selections read at most once per expansion, by render and output alike
+
+	def __init__(self, cache):
+		super().__init__()
+		self.cache = cache
+		self.contents = {}
+
+	def __enter__(self):
+		CURRENT.snapshot = self
+		return self
+
+	def __exit__(self, excType, exc, traceback):
+		CURRENT.snapshot = None
+
+	def get(self, name='CLIPBOARD'):
+		if name not in self.contents:
+			self.contents[name] = self.cache.get(name)
+		return self.contents[name]
+
+	def text(self, name='CLIPBOARD'):
+		return self.get(name)[0]
+
+
+def snapshot():
+	return getattr(CURRENT, 'snapshot', None)
+
+
+class MacpyBackend(object):
+
+	def __init__(self):
+		super().__init__()
+		self.keyboard = Keyboard()
+		self.pointer = None
+		self.selections = {}
+		self.hooked = False
+
+	def getPointer(self):
+		if self.pointer is None:
+			self.pointer = Pointer()
+		return self.pointer
+
+	def selection(self, name='CLIPBOARD'):
+		if name not in self.selections:
+			self.selections[name] = Selection(name)
+		return self.selections[name]
+
+	def selectionSequence(self, name='CLIPBOARD'):
+		# None when there's no cheap way to tell the selection changed
+		if sys.platform.startswith('win32') and name == 'CLIPBOARD':
+			return windll.user32.GetClipboardSequenceNumber()
+		return None
+
+	def activeWindow(self):
+		if PLATFORM is Platform.WAYLAND:
+			return None
+		return Window.get_active()
+
+	def listWindows(self):
+		return Window.list_windows()
+
+	def installWindowHook(self, callback):
+		# The X11 hook in macpy busy loops and can't be removed cleanly,
+		# polling is cheaper there
+		if PLATFORM is not Platform.WINDOWS:
+			return False
+		Window.install_window_hook(callback)
+		self.hooked = True
+		return True
+
+	def uninstallWindowHook(self):
+		if self.hooked:
+			self.hooked = False
+			# Window.uninstall_window_hook is broken, go to the interface
+			Window._interface.uninstall_window_hook()
+
+	def close(self):
+		try:
+			self.uninstallWindowHook()
+		finally:
+			self.keyboard.close()
+			if self.pointer is not None:
+				self.pointer.close()
+
+
+class RecordingKeyboard(object):
+
+	def __init__(self):
+		super().__init__()
+		self.events = []
+		self.hook = None
+		self.hotstrings = {}
+		self.hotkeys = {}
+
+	def install_keyboard_hook(self, callback, grab=False):
+		self.hook = callback
+
+	def uninstall_keyboard_hook(self):
+		self.hook = None
+
+	def init_hotkeys(self):
+		pass
+
+	def uninit_hotkeys(self):
+		pass
+
+	def register_hotstring(self, string, triggers, callback):
+		hotstring = HotString(string, triggers)
+		self.hotstrings[hotstring] = callback
+		return hotstring
+
+	def unregister_hotstring(self, hotstring):
+		self.hotstrings.pop(hotstring, None)
+
+	def register_hotkey(self, key, modifiers, callback):
+		hotkey = HotKey(key, modifiers)
+		self.hotkeys[hotkey] = callback
+		return hotkey
+
+	def unregister_hotkey(self, hotkey):
+		self.hotkeys.pop(hotkey, None)
+
+	def fireHotstring(self, string, triggers=(), trigger=None):
+		event = HotString(string, triggers, trigger)
+		self.hotstrings[event](event)
+
+	def fireHotkey(self, key, modifiers=()):
+		event = HotKey(key, modifiers)
+		self.hotkeys[event](event)
+
+	def keypress(self, key, state=None):
+		self.events.append(('key', key, state))
+
+	def type(self, string):
+		self.events.append(('type', string))
+
+	def close(self):
+		pass
+
+
+class RecordingWindow(object):
+
+	def __init__(self, wm_class='', title='', size=(800, 600)):
+		super().__init__()
+		self.wm_class = wm_class
+		self.title = title
+		self.size = size
+		self.pid = None
+		self.events = []
+
+	def send_event(self, event):
+		self.events.append(event)
+
+
+class RecordingSelection(object):
+
+	def __init__(self, selection='CLIPBOARD'):
+		super().__init__()
+		self.selection = selection
+		self.text = None
+		self.html = None
+		self.history = []
+		self.sequence = 0
+		self.reads = 0
+
+	def get_text(self):
+		return self.text
+
+	def set_text(self, text):
+		self.set_with_rich_text(text, None)
+
+	def get_with_rich_text(self):
+		self.reads += 1
+		return self.text, self.html
+
+	def set_with_rich_text(self, text, html):
+		self.text = text
+		self.html = html
+		self.history.append((text, html))
+		self.sequence += 1
+
+
+class RecordingPointer(object):
+
+	def __init__(self):
+		super().__init__()
+		self.events = []
+
+	def click(self, key, state=None):
+		self.events.append(('click', key, state))
+
+	def close(self):
+		pass
+
+
+class RecordingBackend(object):
+
+	def __init__(self, window=None):
+		super().__init__()
+		self.keyboard = RecordingKeyboard()
+		self.pointer = RecordingPointer()
+		self.window = window if window is not None else RecordingWindow()
+		self.windows = [self.window]
+		self.selections = {}
+		self.hook = None
+
+	def getPointer(self):
+		return self.pointer
+
+	def selection(self, name='CLIPBOARD'):
+		if name not in self.selections:
+			self.selections[name] = RecordingSelection(name)
+		return self.selections[name]
+
+	def selectionSequence(self, name='CLIPBOARD'):
+		return self.selection(name).sequence
+
+	def activeWindow(self):
+		return self.window
+
+	def listWindows(self):
+		return tuple(self.windows)
+
+	def installWindowHook(self, callback):
+		self.hook = callback
+		return True
+
+	def uninstallWindowHook(self):
+		self.hook = None
+
+	def focus(self, window):
+		if window not in self.windows:
+			self.windows.append(window)
+		self.window = window
+		if self.hook:
+			self.hook(WindowEvent(window, WindowEventType.FOCUSED))
+
+	def close(self):
+		self.uninstallWindowHook()
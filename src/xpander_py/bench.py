@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import random
+import tracemalloc
+from enum import Enum
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from .fs import Settings, Manager
+from .service import Service
+from .backend import RecordingBackend, RecordingWindow
+from .context import PHRASES
+from . import trace
+
+
+KINDS = {
+	'plain': {
+		'type': 'plaintext',
+		'method': 'type',
+		'body': 'Lorem ipsum dolor sit amet, phrase number {n}.',
+	},
+	'rich': {
+		'type': 'richtext',
+		'method': 'paste',
+		'body': '<p><b>Lorem</b> ipsum <i>dolor</i> sit amet, phrase {n}.</p>',
+	},
+	'tabstop': {
+		'type': 'plaintext',
+		'method': 'paste',
+		'body': 'Dear $|,\n\nthank you for message {n}.\n\nRegards,\n$|',
+	},
+	'keys': {
+		'type': 'plaintext',
+		'method': 'type',
+		'body': 'Name {n}{{{{ key("TAB") }}}}Surname{{{{ key("ENTER") }}}}',
+	},
+	'fillin': {
+		'type': 'plaintext',
+		'method': 'paste',
+		'body': 'Hello {{{{ fillentry("name", "Oz") }}}}, order {n}.',
+	},
+}
+
+
+def percentile(values, fraction):
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def generate(root, size, kinds):
+	phrases = []
+	for n in range(size):
+		kind = kinds[n % len(kinds)]
+		template = KINDS[kind]
+		hotstring = 'x{}{}'.format(kind[0], n)
+		phrase = {
+			'hotstring': hotstring,
+			'triggers': [' '],
+			'type': template['type'],
+			'body': template['body'].format(n=n),
+			'method': template['method'],
+			'wm_class': [],
+			'wm_title': '',
+			'hotkey': None,
+		}
+		folder = root / kind / str(n // 1000)
+		folder.mkdir(parents=True, exist_ok=True)
+		(folder / '{}.json'.format(hotstring)).write_text(json.dumps(phrase))
+		phrases.append(hotstring)
+	return phrases
+
+
+def configure(workdir):
+	os.environ['XDG_CACHE_HOME'] = str(workdir / 'cache')
+	Settings.loadDefaults()
+	Settings.set('phrase_dir', workdir / 'phrases')
+	Settings.set('key_delay', 0)
+	Settings.set('key_delay_max', 0)
+	Settings.set('paste_delay', 0)
+	Settings.set('use_tab', False)
+	Settings.set('watch_phrases', False)
+	Settings.set('trace_file', '')
+
+
+def run(size, expansions, kinds, workdir, seed):
+	root = workdir / 'phrases'
+	hotstrings = generate(root, size, kinds)
+	PHRASES.clear()
+
+	tracemalloc.start()
+	start = time.perf_counter()
+	manager = Manager()
+	changes = manager.load()
+	loadTime = time.perf_counter() - start
+	loadMemory, _ = tracemalloc.get_traced_memory()
+
+	Settings.set('queue_size', expansions)
+	backend = RecordingBackend(RecordingWindow('bench', 'xpander benchmark'))
+	service = Service(backend)
+	start = time.perf_counter()
+	for change in changes:
+		service.registerPhrase(change.new)
+	registerTime = time.perf_counter() - start
+
+	Settings.set('trace_size', expansions)
+	trace.clear()
+	service.start()
+	rng = random.Random(seed)
+	start = time.perf_counter()
+	for _ in range(expansions):
+		backend.keyboard.fireHotstring(rng.choice(hotstrings), (' ', ), ' ')
+	while len(trace.traces()) < expansions:
+		time.sleep(0.001)
+	elapsed = time.perf_counter() - start
+	_, peakMemory = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	phrases = [change.new for change in changes if change.new]
+	phraseSize = footprint(phrases) / len(phrases) if phrases else 0
+	service.enqueue(None, None)
+
+	traces = trace.traces()
+	queue = [t['stages']['queue'] + t['stages']['dispatch'] for t in traces]
+	latency = [t['total'] - wait for t, wait in zip(traces, queue)]
+	render = [t['render'] for t in traces]
+	return {
+		'phrases': size,
+		'expansions': expansions,
+		'load': loadTime,
+		'register': registerTime,
+		'expansions_per_sec': expansions / elapsed,
+		'p50': percentile(latency, 0.5),
+		'p99': percentile(latency, 0.99),
+		'render_p50': percentile(render, 0.5),
+		'render_p99': percentile(render, 0.99),
+		'queue_p99': percentile(queue, 0.99),
+		'memory_per_phrase': loadMemory / size,
+		'phrase_size': phraseSize,
+		'peak_memory': peakMemory,
+		'keyboard_events': len(backend.keyboard.events),
+	}
+
+
+def footprint(objects):
+	# Deep size of objects, anything they share is only counted once
+	seen = set()
+	pending = list(objects)
+	size = 0
+	while pending:
+		obj = pending.pop()
+		if id(obj) in seen or obj is None or isinstance(obj, type):
+			continue
+		seen.add(id(obj))
+		size += sys.getsizeof(obj)
+		if isinstance(obj, dict):
+			pending.extend(obj.keys())
+			pending.extend(obj.values())
+		elif isinstance(obj, (tuple, list, set, frozenset)):
+			pending.extend(obj)
+		elif hasattr(obj, '__slots__') and not isinstance(obj, Enum):
+			pending.extend(
+				getattr(obj, slot, None) for slot in obj.__slots__
+				if slot != '__weakref__'
+			)
+		elif hasattr(obj, '__dict__') and not isinstance(obj, Enum):
+			pending.append(obj.__dict__)
+	return size
+
+
+def report(results, out):
+	columns = (
+		('phrases', '{:.0f}'), ('load', '{:.3f}s'), ('register', '{:.3f}s'),
+		('expansions_per_sec', '{:.1f}/s'), ('p50', '{:.2f}ms'),
+		('p99', '{:.2f}ms'), ('render_p99', '{:.2f}ms'),
+		('memory_per_phrase', '{:.0f}B'), ('phrase_size', '{:.0f}B'),
+		('peak_memory', '{:.0f}B'),
+	)
+	rows = [[name for name, _ in columns]]
+	for result in results:
+		row = []
+		for name, fmt in columns:
+			value = result[name]
+			if name in {'p50', 'p99', 'render_p99'}:
+				value *= 1000
+			row.append(fmt.format(value))
+		rows.append(row)
+	widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+	for row in rows:
+		print('  '.join(cell.rjust(width) for cell, width in zip(row, widths)), file=out)
+
+
+def main(argv=None):
+	parser = ArgumentParser(
+		description='Benchmark xpander phrase loading, rendering and output '
+		'against an in-memory recording backend.'
+	)
+	parser.add_argument('--sizes', default='100,1000,10000,50000')
+	parser.add_argument('--expansions', type=int, default=1000)
+	parser.add_argument('--kinds', default=','.join(KINDS))
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--json', action='store_true')
+	args = parser.parse_args(argv)
+	kinds = args.kinds.split(',')
+	out = sys.stdout
+	results = []
+	for size in (int(size) for size in args.sizes.split(',')):
+		with TemporaryDirectory() as workdir:
+			workdir = Path(workdir)
+			configure(workdir)
+			with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+				result = run(size, args.expansions, kinds, workdir, args.seed)
+		results.append(result)
+		if args.json:
+			print(json.dumps(result), file=out)
+	if not args.json:
+		report(results, out)
+
+
+if __name__ == '__main__':
+	main()
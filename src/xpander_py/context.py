@@ -1,16 +1,14 @@
 import sys
 from datetime import datetime, timedelta
-from subprocess import run as spawn, PIPE
-from shlex import split as shlexSplit
-from random import choice as randomChoice
-from string import ascii_lowercase
-from klembord import Selection
+from .backend import Backend, snapshot
+from .runner import Runner
+from .sources import Sources
+from .instructions import field
 
 
 PHRASES = {}
-Clipboard = Selection()
-if sys.platform.startswith('linux'):
-	Primary = Selection('PRIMARY')
+DEPENDENTS = {}
+GENERATION = 0
 
 
 _year = 'YEAR'
@@ -31,10 +29,6 @@ CONTEXT = {
 }
 
 
-def genId(length=7):
-	return ''.join(randomChoice(ascii_lowercase) for _ in range(length))
-
-
 def timeFunc(period=0, unit=None, format='%Y-%m-%d'):
 	now = datetime.now()
 	if unit is None:
@@ -50,74 +44,47 @@ def timeFunc(period=0, unit=None, format='%Y-%m-%d'):
 		return (now + (period * unit)).strftime(format)
 
 
-def run(command, dir=None, shell=False, stderr=False):
-	proc = spawn(
-		shlexSplit(command),
-		cwd=dir,
-		shell=shell,
-		timeout=1,
-		text=True,
-		stdout=PIPE,
-		stderr=PIPE,
-	)
-	if stderr:
-		return proc.stderr.strip()
-	else:
-		return proc.stdout.strip()
+def run(command, dir=None, shell=False, stderr=False, timeout=None, ttl=None):
+	return Runner.run(command, dir, shell, stderr, timeout, ttl)
+
+
+def prefetch(command, dir=None, shell=False, ttl=None):
+	Runner.prefetch(command, dir, shell, ttl)
+	return ''
+
+
+def lookup(name, key, field=None, default=''):
+	row = Sources.lookup(name, key)
+	if row is None:
+		return default
+	if field is None:
+		return row
+	try:
+		return row[field]
+	except (KeyError, IndexError, TypeError):
+		return default
+
+
+def rows(name):
+	return Sources.rows(name)
 
 
 def fillentry(name='', default='', width=15):
-	htmlId = genId()
-	template = """
-<div class="xpander-fillin input-field inline">
-	<input id="{id}" name="{name}" type="text" value="{value}" size="{width}">
-	<label for="{id}">{name}</label>
-</div>
-"""
-	return template.format(id=htmlId, name=name, value=default, width=width)
+	return field('entry', name=name, default=default, width=width)
 
 
 def fillmulti(name='', default='', width=20, height=5):
-	htmlId = genId()
-	template = """
-<div class="xpander-fillin input-field inline">
-	<textarea id="{id}" class="materialize-textarea" name="{name}" col="{width}" row="{height}">{default}</textarea>
-	<label for="{id}">{name}</label>
-</div>
-"""
-	return template.format(id=htmlId, name=name, width=width, height=height, default=default)
+	return field(
+		'multi', name=name, default=default, width=width, height=height
+	)
 
 
 def fillchoice(*choices, name='', default=None):
-	htmlId = genId()
-	selectTemplate = """
-<div class="xpander-fillin input-field inline">
-	<select id="{id}" name="{name}">{options}</select>
-	<label for="{id}">{name}</label>
-</div>
-"""
-	optionTemplate = '<option value="{value}">{value}</option>'
-	options = []
-	if default:
-		options.append(
-			'<option selected value="{value}">{value}</option>'.format(value=default)
-		)
-	for choice in choices:
-		options.append(optionTemplate.format(value=choice))
-	return selectTemplate.format(id=htmlId, name=name, options='\n'.join(options))
+	return field('choice', name=name, default=default, choices=choices)
 
 
 def filloptional(text, name=''):
-	htmlId = genId()
-	template = """
-<div class="xpander-fillin">
-	<label>
-		<input id="{id}" type="checkbox" name="{name}" value="{value}" />
-		<span>{value}</span>
-	</label>
-</div>
-"""
-	return template.format(name=name, value=text, id=htmlId)
+	return field('optional', name=name, text=text)
 
 
 def key(key, state=None):
@@ -126,12 +93,48 @@ def key(key, state=None):
 
 
 def clipboard():
-	text = Clipboard.get_text()
+	current = snapshot()
+	if current is not None:
+		return current.text()
+	text = Backend.get().selection().get_text()
 	return text.replace('\x00', '') if text else ''
 
 
 def primary():
-	return Primary.get_text() or ''
+	current = snapshot()
+	if current is not None:
+		return current.text('PRIMARY')
+	return Backend.get().selection('PRIMARY').get_text() or ''
+
+
+def generation():
+	return GENERATION
+
+
+def invalidate(name):
+	global GENERATION
+	GENERATION += 1
+	pending = [name]
+	seen = set()
+	while pending:
+		current = pending.pop()
+		if current in seen:
+			continue
+		seen.add(current)
+		if current in PHRASES:
+			PHRASES[current].invalidate()
+		pending.extend(DEPENDENTS.get(current, ()))
+
+
+def addPhrase(phrase):
+	PHRASES[phrase.name] = phrase
+	invalidate(phrase.name)
+
+
+def removePhrase(phrase):
+	if PHRASES.get(phrase.name) is phrase:
+		del PHRASES[phrase.name]
+		invalidate(phrase.name)
 
 
 def phrase(name):
@@ -142,6 +145,9 @@ def phrase(name):
 
 CONTEXT['time'] = timeFunc
 CONTEXT['run'] = run
+CONTEXT['prefetch'] = prefetch
+CONTEXT['lookup'] = lookup
+CONTEXT['rows'] = rows
 CONTEXT['fillentry'] = fillentry
 CONTEXT['fillmulti'] = fillmulti
 CONTEXT['fillchoice'] = fillchoice
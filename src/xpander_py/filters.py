@@ -0,0 +1,67 @@
+import re
+from fnmatch import translate
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def titleMatcher(pattern):
+	if not pattern:
+		return None
+	if pattern.startswith('re:'):
+		try:
+			return re.compile(pattern[3:]).search
+		except re.error:
+			return lambda title: False
+	if pattern.startswith('glob:'):
+		return re.compile(translate(pattern[5:])).match
+	return lambda title: pattern in title
+
+
+class PhraseIndex(object):
+
+	def __init__(self):
+		super().__init__()
+		self.phrases = ()
+		self.titled = ()
+		self.classes = {}
+		self.generic = ()
+
+	def __len__(self):
+		return len(self.phrases)
+
+	def add(self, phrase):
+		self.rebuild(self.phrases + (phrase, ))
+
+	def remove(self, phrase):
+		self.rebuild(tuple(p for p in self.phrases if p is not phrase))
+
+	def rebuild(self, phrases):
+		phrases = tuple(sorted(phrases, key=lambda phrase: phrase.name or ''))
+		classes = {}
+		for phrase in phrases:
+			if not phrase.wm_title:
+				for wmClass in phrase.wm_class:
+					classes.setdefault(wmClass, []).append(phrase)
+		self.titled = tuple(phrase for phrase in phrases if phrase.wm_title)
+		self.classes = {wmClass: tuple(bucket) for wmClass, bucket in classes.items()}
+		self.generic = tuple(
+			phrase for phrase in phrases
+			if not phrase.wm_title and not phrase.wm_class
+		)
+		self.phrases = phrases
+
+	def fallback(self):
+		# Without window information every phrase would expand, prefer generic ones
+		if self.generic:
+			return self.generic[0]
+		return self.phrases[0] if self.phrases else None
+
+	def select(self, wmClass, title):
+		# A title filter decides on its own, like filtering per phrase did
+		if self.titled:
+			current = title() or ''
+			for phrase in self.titled:
+				if titleMatcher(phrase.wm_title)(current):
+					return phrase
+		candidates = self.classes.get(wmClass) or self.generic
+		return candidates[0] if candidates else None
@@ -1,5 +1,14 @@
+import os
 import json
+import time
+import sqlite3
 from pathlib import Path
+from hashlib import sha1
+from collections import namedtuple
+from threading import RLock
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, BadZipFile
+from shutil import copyfile
 try:
 	from importlib import resources
 except ImportError:
@@ -7,13 +16,16 @@ except ImportError:
 from configparser import ConfigParser
 # from ast import literal_eval
 from traceback import format_tb
-from appdirs import user_config_dir
+from appdirs import user_config_dir, user_cache_dir
 from macpy import Key
 import xpander_data
 import xpander_data.examples
-from .phrase import asPhrase
+from .phrase import asPhrase, phraseToDict
 from .server import Server
-from .context import PHRASES
+from .context import addPhrase, removePhrase
+from .template import STATS, useCache, resetStats
+from .util import Stopwatch
+from .library import Library, isLibrary
 
 
 try:
@@ -29,6 +41,10 @@ class Settings(object):
 	def userConfig(cls):
 		return Path(user_config_dir()) / PKG['name'] / 'settings.ini'
 
+	@classmethod
+	def userCache(cls):
+		return Path(user_cache_dir()) / PKG['name']
+
 	@classmethod
 	def getHotkey(cls, option):
 		# key = literal_eval(cls.parser.get('HOTKEY', option))
@@ -53,6 +69,17 @@ class Settings(object):
 			string = json.dumps((keyName, tuple(modNames)))
 			cls.parser.set('HOTKEY', option, string)
 
+	@classmethod
+	def getSources(cls):
+		if not cls.parser.has_section('SOURCES'):
+			return {}
+		defaults = cls.parser.defaults()
+		# Left as JSON text, a broken entry must only disable its own source
+		return {
+			name: cls.parser.get('SOURCES', name, raw=True)
+			for name in cls.parser.options('SOURCES') if name not in defaults
+		}
+
 	@classmethod
 	def get(cls, option):
 		return cls.parser.get('DEFAULT', option)
@@ -65,14 +92,21 @@ class Settings(object):
 	def getBool(cls, option):
 		return cls.parser.getboolean('DEFAULT', option)
 
+	@classmethod
+	def getFloat(cls, option):
+		return cls.parser.getfloat('DEFAULT', option)
+
 	@classmethod
 	def getPath(cls, option):
 		return Path(cls.parser.get('DEFAULT', option))
 
+	@classmethod
+	def loadDefaults(cls):
+		cls.parser.read_string(resources.read_text(xpander_data, 'settings.ini'))
+
 	@classmethod
 	def load(cls):
-		# with resources.path(xpander_data, 'settings.ini') as default:
-		# 	return cls.parser.read((str(default), cls.userConfig()))
+		cls.loadDefaults()
 		return cls.parser.read([cls.userConfig()])
 
 	@classmethod
@@ -81,13 +115,28 @@ class Settings(object):
 			cls.parser.write(fd)
 
 
+INDEX_VERSION = 1
+Change = namedtuple('Change', ('path', 'old', 'new'))
+Fingerprint = namedtuple('Fingerprint', ('mtime', 'size', 'hash'))
+Loaded = namedtuple(
+	'Loaded', ('path', 'fingerprint', 'phrase', 'unchanged', 'failed'),
+	defaults=(False,),
+)
+
+
 class Manager(object):
 
 	def __init__(self):
 		super().__init__()
 		self.phrases = {}
+		self.fingerprints = {}
+		self.root = None
+		self.lock = RLock()
+		useCache(Settings.userCache() / 'templates')
 
 	def load(self):
+		watch = Stopwatch()
+		resetStats()
 		root = Settings.getPath('phrase_dir').expanduser()
 		if not root.exists():
 			examples = root / 'Examples'
@@ -97,25 +146,424 @@ class Manager(object):
 					(examples / example).write_text(
 						resources.read_text(xpander_data.examples, example)
 					)
-		for filepath in root.glob('**/*.json'):
-			phrase = self.loadPhrase(filepath, root)
-			if phrase:
-				self.phrases[str(filepath.resolve())] = phrase
-				PHRASES[phrase.name] = phrase
+		root = root.resolve()
+		if root != self.root:
+			# Relative paths change with the root, force everything to reload
+			self.root = root
+			self.fingerprints = dict.fromkeys(self.fingerprints)
+		paths = sorted(str(filepath.resolve()) for filepath in root.glob('**/*.json'))
+		watch.lap('scan')
+		changes = []
+		seen = set(paths)
+		for path in tuple(self.fingerprints):
+			if path not in seen:
+				change = self.remove(path)
+				if change:
+					changes.append(change)
+		errors = []
+		updated, failed = self.updateMany(paths, errors=errors, watch=watch)
+		changes.extend(updated)
+		self.reportErrors(errors)
+		summary = self.summarize(changes)
+		Server.send({
+			'type': 'phrase',
+			'action': 'loaded',
+			'count': len(self.phrases),
+			'added': len(summary['added']),
+			'removed': len(summary['removed']),
+			'changed': len(summary['changed']),
+			'failed': len(failed),
+			'compiled': STATS['compiled'],
+			'cached': STATS['cached'],
+			'time': watch.total,
+			'timing': watch.phases,
+		})
+		return changes
 
-	def loadPhrase(self, filepath, root):
-		filepath = filepath if isinstance(filepath, Path) else Path(filepath)
+	def pool(self, count):
+		workers = min(count, max(1, int(Settings.getFloat('load_workers'))))
+		if workers < 2:
+			return None
+		return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='xpander load')
+
+	def compact(self, phrases, compile=True):
+		pool = self.pool(len(phrases)) if compile else None
+		if pool is None:
+			for phrase in phrases:
+				phrase.compact(compile)
+			return
+		with pool:
+			for _ in pool.map(lambda phrase: phrase.compact(), phrases):
+				pass
+
+	@staticmethod
+	def reportErrors(errors):
+		if errors:
+			errors.sort(key=lambda error: error['path'])
+			Server.sendError({
+				'type': 'phraseLoad',
+				'message': 'Error loading {} phrase(s)'.format(len(errors)),
+				'errors': errors,
+			})
+
+	@staticmethod
+	def indexPath():
+		return Settings.userCache() / 'index.json'
+
+	def loadIndex(self):
+		start = time.perf_counter()
+		root = Settings.getPath('phrase_dir').expanduser().resolve()
 		try:
-			with filepath.open() as fd:
-				phrase = json.loads(fd.read(), object_hook=asPhrase)
+			index = json.loads(self.indexPath().read_bytes())
+			if index['version'] != INDEX_VERSION or index['root'] != str(root):
+				return []
+			changes = []
+			for entry in index['phrases']:
+				filepath = root / entry['path']
+				path = str(filepath)
+				self.fingerprints[path] = Fingerprint(
+					entry['mtime'], entry['size'], entry['hash']
+				)
+				if entry['phrase'] is None:
+					continue
+				phrase = asPhrase(entry['phrase'])
 				phrase.name = filepath.stem
-				phrase.path = filepath.expanduser().relative_to(root)
-				return phrase
+				phrase.path = Path(entry['path'])
+				phrase.source = path
+				self.phrases[path] = phrase
+				addPhrase(phrase)
+				changes.append(Change(path, None, phrase))
+		except FileNotFoundError:
+			return []
 		except Exception as e:
-			msg = {
-				'type': 'phraseLoad',
-				'message': 'Error loading phrase at {}'.format(filepath),
+			Server.sendError({
+				'type': 'phraseIndex',
+				'message': 'Error loading phrase index, rebuilding',
+				'error': repr(e),
+				'traceback': format_tb(e.__traceback__),
+			})
+			self.phrases = {}
+			self.fingerprints = {}
+			return []
+		self.root = root
+		Server.send({
+			'type': 'phrase',
+			'action': 'loaded',
+			'count': len(self.phrases),
+			'index': True,
+			'time': time.perf_counter() - start,
+		})
+		return changes
+
+	def saveIndex(self):
+		if self.root is None:
+			return
+		phrases = []
+		for path, fingerprint in self.fingerprints.items():
+			phrase = self.phrases.get(path)
+			phrases.append({
+				'path': str(Path(path).relative_to(self.root)),
+				'mtime': fingerprint.mtime,
+				'size': fingerprint.size,
+				'hash': fingerprint.hash,
+				'phrase': phraseToDict(phrase, body=False) if phrase else None,
+			})
+		index = {
+			'version': INDEX_VERSION,
+			'root': str(self.root),
+			'phrases': phrases,
+		}
+		indexPath = self.indexPath()
+		indexPath.parent.mkdir(parents=True, exist_ok=True)
+		temp = indexPath.with_suffix('.tmp')
+		temp.write_text(json.dumps(index, separators=(',', ':')))
+		temp.replace(indexPath)
+
+	def loadLibrary(self, libraryPath):
+		start = time.perf_counter()
+		root = Settings.getPath('phrase_dir').expanduser().resolve()
+		if not isLibrary(libraryPath):
+			return []
+		changes = []
+		try:
+			with Library(libraryPath) as library:
+				if library.get('root') != str(root):
+					return []
+				for relative, content, mtime, size, digest in library.entries():
+					filepath = root / relative
+					path = str(filepath)
+					self.fingerprints[path] = Fingerprint(mtime, size, digest)
+					phrase = self.loadPhrase(filepath, root, content)
+					if phrase:
+						self.phrases[path] = phrase
+						addPhrase(phrase)
+						changes.append(Change(path, None, phrase))
+		except (sqlite3.Error, ValueError) as e:
+			Server.sendError({
+				'type': 'phraseLibrary',
+				'message': 'Error loading phrase library {}'.format(libraryPath),
 				'error': repr(e),
 				'traceback': format_tb(e.__traceback__),
-			}
+			})
+			for change in changes:
+				removePhrase(change.new)
+			self.phrases = {}
+			self.fingerprints = {}
+			return []
+		self.root = root
+		Server.send({
+			'type': 'phrase',
+			'action': 'loaded',
+			'count': len(self.phrases),
+			'library': True,
+			'time': time.perf_counter() - start,
+		})
+		return changes
+
+	def saveLibrary(self, libraryPath, changes=None):
+		if self.root is None:
+			return 0
+		with Library(libraryPath) as library:
+			# Pack everything unless the library already mirrors this root
+			full = changes is None or library.get('root') != str(self.root)
+			if full:
+				paths = tuple(self.fingerprints)
+			else:
+				paths = tuple(change.path for change in changes)
+			entries = []
+			removed = []
+			for path in paths:
+				relative = str(Path(path).relative_to(self.root))
+				fingerprint = self.fingerprints.get(path)
+				try:
+					if fingerprint is None:
+						raise FileNotFoundError(path)
+					content = Path(path).read_bytes()
+				except OSError:
+					removed.append(relative)
+					continue
+				entries.append((
+					relative, content,
+					fingerprint.mtime, fingerprint.size, fingerprint.hash,
+				))
+			library.store(entries, replace=full)
+			library.delete(removed)
+			library.set('root', str(self.root))
+			return library.count()
+
+	def read(self, path, force=False, errors=None):
+		# Stat, hash and parse without touching manager state, safe in a pool
+		filepath = Path(path).expanduser().resolve()
+		path = str(filepath)
+		previous = self.fingerprints.get(path)
+		try:
+			stat = filepath.stat()
+			if (
+				not force and previous
+				and previous.mtime == stat.st_mtime_ns
+				and previous.size == stat.st_size
+			):
+				return Loaded(path, previous, None, True)
+			content = filepath.read_bytes()
+		except FileNotFoundError:
+			return Loaded(path, None, None, False)
+		except OSError as e:
+			# Keep whatever was loaded before, the next reload retries
+			self.loadError(filepath, e, errors)
+			if previous is None:
+				return Loaded(path, None, None, False, True)
+			return Loaded(path, previous, None, True, True)
+		fingerprint = Fingerprint(
+			stat.st_mtime_ns, stat.st_size, sha1(content).hexdigest()
+		)
+		if not force and previous and previous.hash == fingerprint.hash:
+			return Loaded(path, fingerprint, None, True)
+		phrase = self.loadPhrase(filepath, self.root, content, errors)
+		return Loaded(path, fingerprint, phrase, False)
+
+	def apply(self, loaded):
+		path = loaded.path
+		if loaded.fingerprint is None:
+			return self.remove(path)
+		self.fingerprints[path] = loaded.fingerprint
+		if loaded.unchanged:
+			return None
+		old = self.phrases.pop(path, None)
+		if old:
+			removePhrase(old)
+		if loaded.phrase:
+			self.phrases[path] = loaded.phrase
+			addPhrase(loaded.phrase)
+		if old or loaded.phrase:
+			return Change(path, old, loaded.phrase)
+		return None
+
+	def update(self, path, force=False):
+		return self.apply(self.read(path, force))
+
+	def updateMany(self, paths, force=False, errors=None, watch=None):
+		paths = list(dict.fromkeys(paths))
+		report = errors is None
+		errors = [] if report else errors
+		pool = self.pool(len(paths))
+		if pool is None:
+			results = [self.read(path, force, errors) for path in paths]
+		else:
+			with pool:
+				results = list(
+					pool.map(lambda path: self.read(path, force, errors), paths)
+				)
+		if watch:
+			watch.lap('read')
+		# Results keep the order of paths, so merging is deterministic
+		changes = []
+		failed = []
+		for loaded in results:
+			if loaded.failed or (
+				loaded.fingerprint and not loaded.unchanged and not loaded.phrase
+			):
+				failed.append(loaded.path)
+			change = self.apply(loaded)
+			if change:
+				changes.append(change)
+		if watch:
+			watch.lap('apply')
+		self.compact(
+			[change.new for change in changes if change.new],
+			Settings.getBool('precompile'),
+		)
+		if watch:
+			watch.lap('compile')
+		if report:
+			self.reportErrors(errors)
+		return changes, failed
+
+	def importPaths(self, paths, folder='', overwrite=False):
+		target = (self.root / folder).resolve()
+		if target != self.root and self.root not in target.parents:
+			raise ValueError('Import folder {} is outside phrase directory'.format(folder))
+		imported = []
+		skipped = []
+		failed = []
+		errors = []
+		for path in paths:
+			source = Path(path).expanduser()
+			try:
+				self.importSource(source, target, overwrite, imported, skipped)
+			except (OSError, ValueError, BadZipFile, sqlite3.Error) as e:
+				# Files written before the error are still loaded below
+				failed.append(str(source))
+				errors.append({
+					'type': 'phraseImport',
+					'message': 'Error importing {}'.format(source),
+					'path': str(source),
+					'error': repr(e),
+					'traceback': format_tb(e.__traceback__),
+				})
+		changes, invalid = self.updateMany(imported, force=True, errors=errors)
+		self.reportErrors(errors)
+		return changes, failed + invalid, skipped
+
+	@staticmethod
+	def importSource(source, target, overwrite, imported, skipped):
+		if isLibrary(source):
+			with Library(source) as library:
+				library.unpack(target, overwrite, imported, skipped)
+			return
+		if source.suffix == '.zip':
+			with ZipFile(str(source)) as archive:
+				for member in archive.infolist():
+					name = Path(member.filename)
+					if member.is_dir() or name.suffix != '.json':
+						continue
+					if name.is_absolute() or '..' in name.parts:
+						skipped.append(member.filename)
+						continue
+					destination = target / name
+					if destination.exists() and not overwrite:
+						skipped.append(str(destination))
+						continue
+					destination.parent.mkdir(parents=True, exist_ok=True)
+					destination.write_bytes(archive.read(member))
+					imported.append(str(destination))
+			return
+		if source.is_dir():
+			files = [
+				(child, target / source.name / child.relative_to(source))
+				for child in source.glob('**/*.json')
+			]
+		else:
+			files = [(source, target / source.name)]
+		for child, destination in files:
+			if destination.exists() and not overwrite:
+				skipped.append(str(destination))
+				continue
+			destination.parent.mkdir(parents=True, exist_ok=True)
+			copyfile(str(child), str(destination))
+			imported.append(str(destination))
+
+	def updatePaths(self, paths):
+		candidates = []
+		for path in paths:
+			filepath = Path(path).expanduser().resolve()
+			if filepath.suffix == '.json' and not filepath.is_dir():
+				candidates.append(str(filepath))
+			else:
+				prefix = str(filepath) + os.sep
+				candidates.extend(
+					known for known in self.fingerprints if known.startswith(prefix)
+				)
+				if filepath.is_dir():
+					candidates.extend(
+						str(child.resolve()) for child in filepath.glob('**/*.json')
+					)
+		changes, failed = self.updateMany(candidates)
+		return changes
+
+	def remove(self, path):
+		path = str(Path(path).expanduser().resolve())
+		self.fingerprints.pop(path, None)
+		old = self.phrases.pop(path, None)
+		if old:
+			removePhrase(old)
+			return Change(path, old, None)
+		return None
+
+	@staticmethod
+	def summarize(changes):
+		summary = {'added': [], 'removed': [], 'changed': []}
+		for change in changes:
+			if change.old and change.new:
+				summary['changed'].append(change.path)
+			elif change.new:
+				summary['added'].append(change.path)
+			else:
+				summary['removed'].append(change.path)
+		return summary
+
+	def loadPhrase(self, filepath, root, content=None, errors=None):
+		filepath = filepath if isinstance(filepath, Path) else Path(filepath)
+		try:
+			if content is None:
+				content = filepath.read_bytes()
+			phrase = json.loads(content, object_hook=asPhrase)
+			phrase.name = filepath.stem
+			phrase.path = filepath.expanduser().relative_to(root)
+			phrase.source = str(filepath)
+			return phrase
+		except Exception as e:
+			self.loadError(filepath, e, errors)
+
+	@staticmethod
+	def loadError(filepath, e, errors=None):
+		msg = {
+			'type': 'phraseLoad',
+			'message': 'Error loading phrase at {}'.format(filepath),
+			'path': str(filepath),
+			'error': repr(e),
+			'traceback': format_tb(e.__traceback__),
+		}
+		if errors is None:
 			Server.sendError(msg)
+		else:
+			errors.append(msg)
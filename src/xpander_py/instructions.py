@@ -0,0 +1,173 @@
+import re
+import json
+from markupsafe import Markup, escape
+from macpy import Key, KeyState
+
+
+TOKEN = re.compile(
+	r'\$\||\$\+|\$-|\${{(?P<key>[A-Z]+):?(?P<state>UP|DOWN)?}}\$'
+)
+TAGS = re.compile(r'(<!--.*?-->|<[^>]*>)')
+SPACE = re.compile(r'\s+')
+# Fill-in fields are rendered as inline markers holding their spec
+FIELD = re.compile('\ue000(.*?)\ue001', re.S)
+FIELD_START = '\ue000'
+TEXT = 'text'
+KEY = 'key'
+
+
+def stripTags(richText):
+	# Like Markup.striptags, but keeps edge whitespace so runs can be joined
+	return Markup(SPACE.sub(' ', TAGS.sub('', richText))).unescape()
+
+
+def field(kind, **spec):
+	spec['kind'] = kind
+	return '\ue000{}\ue001'.format(json.dumps(spec, sort_keys=True))
+
+
+class Form(object):
+
+	def __init__(self, body, rich=False):
+		super().__init__()
+		self.rich = rich
+		self.fields = []
+		# Text and indices into fields, in order
+		self.segments = []
+		names = {}
+		position = 0
+		for match in FIELD.finditer(body):
+			if match.start() > position:
+				self.segments.append(body[position:match.start()])
+			position = match.end()
+			spec = json.loads(match.group(1))
+			# Fields sharing a name share a value, like the dialog always did
+			name = spec.get('name')
+			if name and name in names:
+				self.segments.append(names[name])
+				continue
+			spec['id'] = 'f{}'.format(len(self.fields))
+			if name:
+				names[name] = len(self.fields)
+			self.segments.append(len(self.fields))
+			self.fields.append(spec)
+		if position < len(body):
+			self.segments.append(body[position:])
+
+	def schema(self):
+		return {
+			'fields': self.fields,
+			'segments': self.segments,
+			'richText': self.rich,
+		}
+
+	def value(self, spec, values):
+		value = values.get(spec['id'])
+		if spec['kind'] == 'optional':
+			return spec.get('text', '') if value else ''
+		if value is None:
+			value = spec.get('default') or ''
+		return str(value).replace(FIELD_START, '')
+
+	def assemble(self, values):
+		parts = []
+		for segment in self.segments:
+			if isinstance(segment, int):
+				spec = self.fields[segment]
+				value = self.value(spec, values)
+				# Optional text is part of the phrase, only typed values are escaped
+				if self.rich and spec['kind'] != 'optional':
+					value = escape(value)
+				parts.append(value)
+			else:
+				parts.append(segment)
+		return ''.join(parts)
+
+	def instructions(self, values):
+		return parse(self.assemble(values), self.rich)
+
+
+class Instructions(object):
+
+	def __init__(self, items, tabStops, length, keep, drop, fillin=None):
+		super().__init__()
+		self.items = items
+		self.tabStops = tabStops
+		self.length = length
+		self.keep = keep
+		self.drop = drop
+		self.fillin = fillin
+
+
+def parse(body, rich=False):
+	if FIELD_START in body:
+		return Instructions(
+			(), (), 0, '$+' in body, '$-' in body,
+			Form(body.replace('$+', '').replace('$-', ''), rich),
+		)
+	items = []
+	tabStops = []
+	keep = drop = False
+	length = 0
+	plainParts = []
+	richParts = []
+	position = 0
+
+	def flush():
+		if plainParts:
+			items.append((
+				TEXT,
+				''.join(plainParts),
+				''.join(richParts) if rich else None,
+			))
+			plainParts.clear()
+			richParts.clear()
+
+	for match in TOKEN.finditer(body):
+		chunk = body[position:match.start()]
+		position = match.end()
+		if chunk:
+			plain = stripTags(chunk) if rich else chunk
+			plainParts.append(plain)
+			richParts.append(chunk)
+			length += len(plain)
+		token = match.group()
+		if token == '$|':
+			tabStops.append(length)
+		elif token == '$+':
+			keep = True
+		elif token == '$-':
+			drop = True
+		else:
+			try:
+				key = getattr(Key, 'KEY_{}'.format(match.group('key')))
+			except AttributeError:
+				continue
+			state = None
+			if match.group('state'):
+				state = KeyState.PRESSED \
+					if match.group('state') == 'DOWN' else KeyState.RELEASED
+			flush()
+			items.append((KEY, key, state))
+	chunk = body[position:]
+	if chunk:
+		plain = stripTags(chunk) if rich else chunk
+		plainParts.append(plain)
+		richParts.append(chunk)
+		length += len(plain)
+	flush()
+
+	if rich:
+		# Match striptags trimming of the whole body
+		texts = [i for i, item in enumerate(items) if item[0] == TEXT]
+		if texts:
+			first = items[texts[0]]
+			stripped = first[1].lstrip()
+			offset = len(first[1]) - len(stripped)
+			items[texts[0]] = (TEXT, stripped, first[2])
+			last = items[texts[-1]]
+			stripped = last[1].rstrip()
+			items[texts[-1]] = (TEXT, stripped, last[2])
+			length -= offset + len(last[1]) - len(stripped)
+			tabStops = [min(max(0, stop - offset), length) for stop in tabStops]
+	return Instructions(tuple(items), tuple(tabStops), length, keep, drop)
@@ -0,0 +1,107 @@
+import sqlite3
+from pathlib import Path
+
+
+LIBRARY_VERSION = 1
+MAGIC = b'SQLite format 3\x00'
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+	key TEXT PRIMARY KEY,
+	value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS phrases (
+	path TEXT PRIMARY KEY,
+	content BLOB NOT NULL,
+	mtime INTEGER NOT NULL,
+	size INTEGER NOT NULL,
+	hash TEXT NOT NULL
+);
+"""
+
+
+def isLibrary(path):
+	try:
+		with open(str(path), 'rb') as fd:
+			return fd.read(len(MAGIC)) == MAGIC
+	except OSError:
+		return False
+
+
+class Library(object):
+
+	def __init__(self, path):
+		super().__init__()
+		self.path = Path(path).expanduser()
+		self.connection = None
+
+	def __enter__(self):
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		self.connection = sqlite3.connect(str(self.path))
+		self.connection.executescript(SCHEMA)
+		version = self.get('version')
+		if version is None:
+			self.set('version', LIBRARY_VERSION)
+		elif int(version) != LIBRARY_VERSION:
+			self.connection.close()
+			raise ValueError('Unsupported phrase library version {}'.format(version))
+		return self
+
+	def __exit__(self, excType, exc, traceback):
+		if excType is None:
+			self.connection.commit()
+		else:
+			self.connection.rollback()
+		self.connection.close()
+		self.connection = None
+
+	def get(self, key):
+		row = self.connection.execute(
+			'SELECT value FROM meta WHERE key = ?', (key, )
+		).fetchone()
+		return row[0] if row else None
+
+	def set(self, key, value):
+		self.connection.execute(
+			'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+			(key, str(value)),
+		)
+
+	def entries(self):
+		return self.connection.execute(
+			'SELECT path, content, mtime, size, hash FROM phrases ORDER BY path'
+		)
+
+	def store(self, entries, replace=False):
+		if replace:
+			self.connection.execute('DELETE FROM phrases')
+		self.connection.executemany(
+			'INSERT OR REPLACE INTO phrases (path, content, mtime, size, hash) '
+			'VALUES (?, ?, ?, ?, ?)',
+			entries,
+		)
+
+	def delete(self, paths):
+		self.connection.executemany(
+			'DELETE FROM phrases WHERE path = ?', ((path, ) for path in paths)
+		)
+
+	def count(self):
+		return self.connection.execute('SELECT COUNT(*) FROM phrases').fetchone()[0]
+
+	def unpack(self, root, overwrite=False, written=None, skipped=None):
+		# Appends as it goes, a failure keeps track of what was written
+		written = [] if written is None else written
+		skipped = [] if skipped is None else skipped
+		for path, content, mtime, size, digest in self.entries():
+			relative = Path(path)
+			if relative.is_absolute() or '..' in relative.parts:
+				skipped.append(path)
+				continue
+			destination = root / relative
+			if destination.exists() and not overwrite:
+				skipped.append(str(destination))
+				continue
+			destination.parent.mkdir(parents=True, exist_ok=True)
+			destination.write_bytes(content)
+			written.append(str(destination))
+		return written, skipped
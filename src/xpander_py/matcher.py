@@ -0,0 +1,128 @@
+from collections import deque
+from threading import Lock
+from macpy import HotString, Key, KeyState
+
+
+MODIFIERS = {
+	getattr(Key, name) for name in (
+		'KEY_SHIFT', 'KEY_LEFTSHIFT', 'KEY_RIGHTSHIFT', 'KEY_CTRL',
+		'KEY_LEFTCTRL', 'KEY_RIGHTCTRL', 'KEY_ALT', 'KEY_LEFTALT',
+		'KEY_RIGHTALT', 'KEY_META', 'KEY_LEFTMETA', 'KEY_RIGHTMETA',
+		'KEY_CAPSLOCK', 'KEY_NUMLOCK',
+	) if hasattr(Key, name)
+}
+
+
+class Node(object):
+	__slots__ = ('next', 'fail', 'matches')
+
+	def __init__(self):
+		self.next = {}
+		self.fail = None
+		# Registered strings ending here, longest first
+		self.matches = ()
+
+
+class HotstringMatcher(object):
+
+	def __init__(self):
+		super().__init__()
+		self.lock = Lock()
+		self.hotstrings = {}
+		self.root = Node()
+		self.dirty = False
+		self.state = self.root
+		self.history = deque(maxlen=1)
+
+	def register_hotstring(self, string, triggers, callback):
+		hotstring = HotString(string, tuple(triggers))
+		with self.lock:
+			self.hotstrings[hotstring] = callback
+			self.dirty = True
+		return hotstring
+
+	def unregister_hotstring(self, hotstring):
+		with self.lock:
+			if self.hotstrings.pop(hotstring, None) is not None:
+				self.dirty = True
+
+	def build(self):
+		# Aho-Corasick automaton over every registered string
+		root = Node()
+		for hotstring in self.hotstrings:
+			node = root
+			for char in hotstring.string:
+				node = node.next.setdefault(char, Node())
+			node.matches = node.matches + (hotstring, )
+		root.fail = root
+		pending = deque()
+		for node in root.next.values():
+			node.fail = root
+			pending.append(node)
+		while pending:
+			node = pending.popleft()
+			node.matches = node.matches + node.fail.matches
+			for char, child in node.next.items():
+				fail = node.fail
+				while char not in fail.next and fail is not root:
+					fail = fail.fail
+				child.fail = fail.next.get(char, root)
+				if child.fail is child:
+					child.fail = root
+				pending.append(child)
+		self.root = self.state = root
+		longest = max((len(h.string) for h in self.hotstrings), default=0)
+		self.history = deque(maxlen=longest + 1)
+		self.dirty = False
+
+	def reset(self):
+		with self.lock:
+			self.state = self.root
+			self.history.clear()
+
+	def step(self, char):
+		node = self.state
+		while char not in node.next and node is not self.root:
+			node = node.fail
+		return node.next.get(char, self.root)
+
+	def feed(self, char):
+		with self.lock:
+			if self.dirty:
+				self.build()
+			# Strings that ended on the previous character and take it as trigger
+			for hotstring in self.state.matches:
+				if char in hotstring.triggers:
+					return self.fire(hotstring, char)
+			self.history.append(self.state)
+			self.state = self.step(char)
+			for hotstring in self.state.matches:
+				if not hotstring.triggers:
+					return self.fire(hotstring, None)
+		return None
+
+	def fire(self, hotstring, trigger):
+		callback = self.hotstrings[hotstring]
+		self.state = self.root
+		self.history.clear()
+		event = HotString(hotstring.string, hotstring.triggers, trigger)
+		return callback, event
+
+	def backspace(self):
+		with self.lock:
+			self.state = self.history.pop() if self.history else self.root
+
+	def hook(self, event):
+		if event.key is Key.KEY_BACKSPACE:
+			if event.state is KeyState.PRESSED:
+				self.backspace()
+		elif event.char:
+			# Like macpy, characters count on release
+			if event.state is KeyState.RELEASED:
+				match = self.feed(event.char)
+				if match:
+					callback, hotstring = match
+					callback(hotstring)
+		elif event.state is KeyState.PRESSED and event.key not in MODIFIERS:
+			# Navigation and the like move the caret away from typed text
+			self.reset()
@@ -1,20 +1,17 @@
 import sys
 import time
-import re
+from threading import Lock
 from markupsafe import escape_silent
-from macpy import Window, Pointer
 from macpy import Key, KeyState, KeyboardEvent, PointerEventButton
 from macpy import PLATFORM, Platform
-from klembord import Selection
 from .phrase import PasteMethod
+from .fs import Settings
+from .util import Stopwatch
+from .instructions import TEXT
 if sys.platform.startswith('win32'):
 	from ctypes import windll, c_void_p, c_uint, c_int, c_bool, POINTER, byref
 
 
-KEYMATCH = re.compile(r'\${{(?P<key>[A-Z]+):?(?P<state>UP|DOWN)?}}\$')
-KEYSPLIT = re.compile(r'(\${{[A-Z]+:?(?:UP|DOWN)?}}\$)')
-
-
 LOCKS = {
 	'NUMLOCK': False,
 	'CAPSLOCK': False,
@@ -29,6 +26,86 @@ MODS = {
 }
 
 
+class Pacer(object):
+
+	def __init__(self, delay=0.005, maximum=0.05, factor=2.0, smoothing=0.2):
+		super().__init__()
+		self.delay = delay
+		self.maximum = maximum
+		self.factor = factor
+		self.smoothing = smoothing
+		self.latency = 0.0
+
+	def configure(self, delay, maximum):
+		self.delay = delay
+		self.maximum = max(delay, maximum)
+
+	def wait(self, elapsed):
+		# Back off when the backend takes longer to accept events
+		self.latency += (elapsed - self.latency) * self.smoothing
+		time.sleep(min(self.maximum, max(self.delay, self.latency * self.factor)))
+
+
+class ClipboardTiming(object):
+	# Time spent in each phase of clipboard pastes, by window class
+
+	def __init__(self):
+		super().__init__()
+		self.phases = {}
+		self.counts = {}
+
+	def record(self, wmClass, watch):
+		phases = self.phases.setdefault(wmClass, {})
+		for phase, elapsed in watch.phases.items():
+			phases[phase] = phases.get(phase, 0.0) + elapsed
+		self.counts[wmClass] = self.counts.get(wmClass, 0) + 1
+
+	def stats(self):
+		stats = []
+		for wmClass, phases in self.phases.items():
+			count = self.counts[wmClass]
+			stats.append({
+				'wm_class': wmClass,
+				'count': count,
+				'phases': {
+					phase: elapsed / count for phase, elapsed in phases.items()
+				},
+			})
+		return stats
+
+
+class Throughput(object):
+
+	def __init__(self):
+		super().__init__()
+		self.lock = Lock()
+		self.totals = {}
+
+	def record(self, method, wmClass, length, elapsed):
+		with self.lock:
+			chars, seconds, count = self.totals.get((method, wmClass), (0, 0.0, 0))
+			self.totals[(method, wmClass)] = (
+				chars + length, seconds + elapsed, count + 1
+			)
+
+	def stats(self):
+		with self.lock:
+			totals = dict(self.totals)
+		return [{
+			'method': method.value,
+			'wm_class': wmClass,
+			'count': count,
+			'chars': chars,
+			'rate': chars / seconds if seconds else None,
+		} for (method, wmClass), (chars, seconds, count) in totals.items()]
+
+
+def chunks(text, size):
+	if size <= 0 or len(text) <= size:
+		return [text]
+	return [text[start:start + size] for start in range(0, len(text), size)]
+
+
 class Output(object):
 	if sys.platform.startswith('win32'):
 		windll.user32.GetForegroundWindow.argtypes = ()
@@ -44,43 +121,73 @@ class Output(object):
 		windll.user32.GetWindowThreadProcessId.argtypes = (c_void_p, POINTER(c_uint))
 		windll.user32.GetWindowThreadProcessId.restype = c_uint
 
-	def __init__(self, keyboard):
+	def __init__(self, backend, windows, selections):
 		super().__init__()
-		self.clipboard = Selection()
+		self.backend = backend
+		self.windows = windows
+		self.selections = selections
+		self.snapshot = None
+		self.cancelled = None
+		self.clipboard = backend.selection()
 		if sys.platform.startswith('linux'):
-			self.primary = Selection('PRIMARY')
-		self.keyboard = keyboard
+			self.primary = backend.selection('PRIMARY')
+		self.keyboard = backend.keyboard
+		self.pacer = Pacer()
+		self.stream = Pacer()
+		self.timing = ClipboardTiming()
+		self.throughput = Throughput()
+		self.watch = None
 		if PLATFORM is Platform.WAYLAND:
-			self.pointer = Pointer()
+			self.pointer = backend.getPointer()
 
 	def paste(self, text, richText):
-		# time.sleep(0.05)
-		content = self.clipboard.get_with_rich_text()
-		time.sleep(0.05)
-		if richText:
-			self.clipboard.set_with_rich_text(text, richText)
-		else:
-			# self.clipboard.set_text(text)
-			self.clipboard.set_with_rich_text(text, str(escape_silent(text)))
-		time.sleep(0.05)
-		self.keyboard.keypress(Key.KEY_CTRL, state=KeyState.PRESSED)
-		self.keyboard.keypress(Key.KEY_V)
-		self.keyboard.keypress(Key.KEY_CTRL, state=KeyState.RELEASED)
-		time.sleep(0.3)
-		self.clipboard.set_with_rich_text(*(str(s) for s in content))
+		wmClass = self.windows.activeClass()
+		watch = Stopwatch()
+		content = self.saved('CLIPBOARD')
+		watch.lap('save')
+		# Rich text can't be cut without breaking its markup
+		parts = [text] if richText else chunks(text, int(Settings.getFloat('paste_chunk')))
+		# Nothing tells when the application has read the clipboard
+		delay = Settings.getFloat('paste_delay')
+		for index, part in enumerate(parts):
+			if index:
+				if self.stopped():
+					break
+				# The previous chunk has to be taken before it's replaced
+				time.sleep(delay)
+				watch.lap('wait')
+			if richText:
+				self.selections.set('CLIPBOARD', part, richText)
+			else:
+				self.selections.set('CLIPBOARD', part, str(escape_silent(part)))
+			watch.lap('set')
+			self.keyboard.keypress(Key.KEY_CTRL, state=KeyState.PRESSED)
+			self.keyboard.keypress(Key.KEY_V)
+			self.keyboard.keypress(Key.KEY_CTRL, state=KeyState.RELEASED)
+			watch.lap('paste')
+		time.sleep(delay)
+		watch.lap('wait')
+		self.selections.set('CLIPBOARD', *content)
+		watch.lap('restore')
+		self.timing.record(wmClass, watch)
+		self.watch = watch
+
+	def saved(self, name):
+		# Render may have read the selection for this expansion already
+		if self.snapshot is not None:
+			return self.snapshot.get(name)
+		return self.selections.get(name)
 
 	def altPaste(self, text, richText):
+		wmClass = self.windows.activeClass()
+		watch = Stopwatch()
 		if sys.platform.startswith('linux'):
-			time.sleep(0.05)
-			content = self.primary.get_with_rich_text()
-			time.sleep(0.05)
-			if richText:
-				self.primary.set_with_rich_text(text, richText)
-			else:
-				self.primary.set_text(text)
-			time.sleep(0.05)
+			content = self.saved('PRIMARY')
+			watch.lap('save')
+			self.selections.set('PRIMARY', text, richText or None)
+			watch.lap('set')
 			if PLATFORM is not Platform.WAYLAND:
-				window = Window.get_active()
+				window = self.windows.active()
 				x, y = window.size
 				window.send_event(PointerEventButton(
 					x // 2,
@@ -98,14 +205,16 @@ class Output(object):
 				))
 			else:
 				self.pointer.click(Key.BTN_MIDDLE)
+			watch.lap('paste')
 			time.sleep(0.05)
-			self.primary.set_with_rich_text(*content)
+			watch.lap('wait')
+			self.selections.set('PRIMARY', *content)
+			watch.lap('restore')
 		else:
-			content = self.clipboard.get_with_rich_text()
-			if richText:
-				self.clipboard.set_with_rich_text(text, richText)
-			else:
-				self.clipboard.set_text(text)
+			content = self.saved('CLIPBOARD')
+			watch.lap('save')
+			self.selections.set('CLIPBOARD', text, richText or None)
+			watch.lap('set')
 			wnd = windll.user32.GetForegroundWindow()
 			tId = windll.user32.GetWindowThreadProcessId(wnd, byref(c_uint(0)))
 			cId = windll.kernel32.GetCurrentThreadId()
@@ -114,61 +223,114 @@ class Output(object):
 			windll.user32.AttachThreadInput(cId, tId, False)
 			# WM_PASTE
 			windll.user32.PostMessageW(hwnd, 0x0302, 0, 0)
+			watch.lap('paste')
 			time.sleep(0.1)
-			self.clipboard.set_with_rich_text(*(str(s) for s in content))
-
-	def send(self, method, text, richText):
-		def output(method, text, richText):
-			if method is PasteMethod.TYPE:
-				self.keyboard.type(text)
-			elif method is PasteMethod.PASTE:
-				self.paste(text, richText)
+			watch.lap('wait')
+			self.selections.set('CLIPBOARD', *content)
+			watch.lap('restore')
+		self.timing.record(wmClass, watch)
+		self.watch = watch
+
+	def choose(self, method, text):
+		# Typing long text is slow and easy to interrupt, paste it instead
+		limit = int(Settings.getFloat('type_max'))
+		if method is PasteMethod.TYPE and limit and len(text) > limit:
+			return PasteMethod.PASTE
+		return method
+
+	def type(self, text):
+		self.stream.configure(
+			Settings.getFloat('key_delay'), Settings.getFloat('key_delay_max')
+		)
+		parts = chunks(text, int(Settings.getFloat('type_chunk')))
+		for index, part in enumerate(parts):
+			if index and self.stopped():
+				break
+			start = time.perf_counter()
+			self.keyboard.type(part)
+			if index < len(parts) - 1:
+				self.stream.wait(time.perf_counter() - start)
+
+	def write(self, method, text, richText):
+		method = self.choose(method, text)
+		wmClass = self.windows.activeClass()
+		start = time.perf_counter()
+		if method is PasteMethod.TYPE:
+			self.type(text)
+		elif method is PasteMethod.PASTE:
+			self.paste(text, richText)
+		else:
+			self.altPaste(text, richText)
+		self.throughput.record(
+			method, wmClass, len(text), time.perf_counter() - start
+		)
+
+	def execute(
+		self, method, instructions, trigger='', snapshot=None, cancelled=None
+	):
+		self.snapshot = snapshot
+		self.cancelled = cancelled
+		try:
+			self.run(method, instructions, trigger)
+		finally:
+			self.snapshot = self.cancelled = None
+
+	def stopped(self):
+		return self.cancelled is not None and self.cancelled()
+
+	def run(self, method, instructions, trigger):
+		items = list(instructions.items)
+		if trigger:
+			if items and items[-1][0] == TEXT:
+				kind, text, richText = items[-1]
+				items[-1] = (TEXT, text + trigger, (richText + trigger) if richText else None)
 			else:
-				self.altPaste(text, richText)
-
-		if KEYSPLIT.search(text):
-			textList = KEYSPLIT.split(text)
-			richTextList = KEYSPLIT.split(richText) \
-				if richText else KEYSPLIT.split(text)
-			for fragment in zip(textList, richTextList):
-				match = KEYMATCH.match(fragment[0])
-				if match:
-					try:
-						key = getattr(Key, 'KEY_{}'.format(match.group('key')))
-					except AttributeError:
-						break
-					state = None
-					if match.group('state'):
-						state = KeyState.PRESSED \
-							if match.group('state') == 'DOWN' \
-								else KeyState.RELEASED
-					self.keyboard.keypress(key, state)
-					if sys.platform.startswith('linux'):
+				items.append((TEXT, trigger, None))
+		events = []
+		for index, item in enumerate(items):
+			if item[0] == TEXT:
+				# Consecutive key tokens are sent as one batch
+				if events:
+					self.keys(events)
+					events = []
+				if self.stopped():
+					# Don't leave keys held down by the part that's skipped
+					self.keys([
+						rest[1:] for rest in items[index:]
+						if rest[0] != TEXT and rest[2] is KeyState.RELEASED
+					])
+					return
+				kind, text, richText = item
+				if text or richText:
+					self.write(method, text, richText)
+					if index < len(items) - 1:
 						time.sleep(0.01)
-				else:
-					output(method, fragment[0], fragment[1])
-				time.sleep(0.01)
-		else:
-			output(method, text, richText)
+			else:
+				events.append(item[1:])
+		if events:
+			self.keys(events)
+
+	def keys(self, events):
+		self.pacer.configure(
+			Settings.getFloat('key_delay'), Settings.getFloat('key_delay_max')
+		)
+		for key, state in events:
+			start = time.perf_counter()
+			self.keyboard.keypress(key, state)
+			self.pacer.wait(time.perf_counter() - start)
 
 	def backspace(self, amount):
-		for i in range(amount):
-			self.keyboard.keypress(Key.KEY_BACKSPACE)
-			time.sleep(0.05)
+		self.keys(((Key.KEY_BACKSPACE, None), ) * amount)
 
 	def backward(self, amount):
-		for i in range(amount):
-			self.keyboard.keypress(Key.KEY_LEFT)
-			time.sleep(0.05)
+		self.keys(((Key.KEY_LEFT, None), ) * amount)
 
 	def forward(self, amount):
-		for i in range(amount):
-			self.keyboard.keypress(Key.KEY_RIGHT)
-			time.sleep(0.05)
+		self.keys(((Key.KEY_RIGHT, None), ) * amount)
 
 	def tab(self):
 		# if PLATFORM is Platform.X11:
-		window = Window.get_active()
+		window = self.windows.active()
 		window.send_event(KeyboardEvent(
 			Key.KEY_TAB,
 			KeyState.PRESSED,
@@ -186,7 +348,3 @@ class Output(object):
 		# elif PLATFORM is Platform.WINDOWS:
 			# self.keyboard.keypress(Key.KEY_TAB)
 			# self.keyboard.type('\t')
-
-	def quit(self):
-		if PLATFORM is Platform.WAYLAND:
-			self.pointer.close()
@@ -1,9 +1,13 @@
 import sys
+import json
 from enum import Enum
+from pathlib import Path
 from traceback import format_exception
-from jinja2 import Template
 from jinja2.exceptions import TemplateError
 from macpy import Key
+from .template import compileTemplate, cachedTemplate, analyze, staticText
+from .context import PHRASES, DEPENDENTS, generation
+from .instructions import parse
 
 
 class PhraseType(Enum):
@@ -17,57 +21,174 @@ class PasteMethod(Enum):
 	ALTPASTE = 'altpaste'
 
 
+SHARED = {}
+
+
+def shared(value):
+	# Many phrases repeat the same triggers and window classes, keep one copy.
+	# Only for those, anything per phrase would stay here for good
+	if isinstance(value, str):
+		return sys.intern(value)
+	return SHARED.setdefault(value, value)
+
+
 class Phrase(object):
+	__slots__ = (
+		'name', '_path', 'source', 'events', 'hotstring', 'triggers', 'type',
+		'_body', '_key', '_analysis', '_rendered', '_instructions', 'method',
+		'wm_class', 'wm_title', 'hotkey',
+	)
 
 	def __init__(
 		self, hotstring, triggers, phrasetype, body, method, wm_class, wm_title,
 		hotkey):
 		super().__init__()
 		self.name = None
-		self.path = None
+		self._path = None
+		self.source = None
 		self.events = ()
 		self.hotstring = hotstring
-		self.triggers = tuple(triggers)
+		self.triggers = shared(tuple(shared(trigger) for trigger in triggers))
 		self.type = PhraseType(phrasetype)
-		self.body = body
-		try:
-			self.template = Template(body)
-		except TemplateError as e:
-			print(format_exception(e.__class__, e, e.__traceback__), file=sys.stderr)
+		self._body = body
+		self._key = None
+		self._analysis = None
+		self._rendered = None
+		self._instructions = None
 		self.method = PasteMethod(method)
-		self.wm_class = tuple(wm_class)
-		self.wm_title = wm_title
+		self.wm_class = shared(tuple(shared(wmClass) for wmClass in wm_class))
+		self.wm_title = shared(wm_title)
 		self.hotkey = None
 		if hotkey is not None:
-			self.hotkey = (
+			self.hotkey = shared((
 				getattr(Key, hotkey[0]),
 				tuple(getattr(Key, mod) for mod in hotkey[1])
-			)
+			))
+
+	@property
+	def path(self):
+		return Path(self._path) if self._path is not None else None
+
+	@path.setter
+	def path(self, path):
+		self._path = shared(str(path)) if path is not None else None
+
+	@property
+	def body(self):
+		if self._body is None and self.source is not None:
+			try:
+				self._body = json.loads(Path(self.source).read_bytes())['body']
+			except Exception as e:
+				print(format_exception(e.__class__, e, e.__traceback__), file=sys.stderr)
+				return ''
+		return self._body or ''
+
+	@property
+	def template(self):
+		template = cachedTemplate(self._key) if self._key else None
+		if template is None:
+			try:
+				template = compileTemplate(self.body)
+				self._key = template.name
+			except TemplateError as e:
+				print(format_exception(e.__class__, e, e.__traceback__), file=sys.stderr)
+		return template
+
+	@property
+	def analysis(self):
+		if self._analysis is None:
+			self._analysis = analyze(self.body)
+			for name in self._analysis.phrases:
+				DEPENDENTS.setdefault(name, set()).add(self.name)
+		return self._analysis
+
+	def compact(self, compile=True):
+		# Static text is kept rendered, templates only need their key, so
+		# bodies of phrases backed by a file can be read again if ever needed
+		if self._body is not None:
+			if self.analysis.static:
+				self.render(None)
+			elif compile:
+				self.template
+			if self.source is not None:
+				self._body = None
 
 	def __hash__(self):
-		return hash(self.name, self.path)
+		return hash((self.name, self._path))
+
+	def __eq__(self, other):
+		if not isinstance(other, Phrase):
+			return NotImplemented
+		return (self.name, self._path) == (other.name, other._path)
+
+	def cacheable(self, seen=None):
+		if self.analysis.volatile:
+			return False
+		seen = set() if seen is None else seen
+		seen.add(self.name)
+		for name in self.analysis.phrases:
+			if name not in seen and name in PHRASES:
+				if not PHRASES[name].cacheable(seen):
+					return False
+		return True
+
+	def uses(self, names, seen=None):
+		# A phrase picked at render time could use anything
+		if self.analysis.dynamic or self.analysis.names & names:
+			return True
+		seen = set() if seen is None else seen
+		seen.add(self.name)
+		for name in self.analysis.phrases:
+			if name not in seen and name in PHRASES:
+				if PHRASES[name].uses(names, seen):
+					return True
+		return False
+
+	def invalidate(self):
+		self._rendered = None
+		self._instructions = None
 
 	def render(self, ctx):
-		return self.template.render(ctx)
+		if self._rendered is not None:
+			return self._rendered
+		if self.analysis.static:
+			text = staticText(self.body)
+		else:
+			current = generation()
+			text = self.template.render(ctx)
+			if not self.cacheable() or current != generation():
+				return text
+		self._rendered = text
+		return text
+
+	def instructions(self, ctx):
+		if self._instructions is not None:
+			return self._instructions
+		instructions = parse(self.render(ctx), self.type is PhraseType.RICHTEXT)
+		if self._rendered is not None:
+			self._instructions = instructions
+		return instructions
 
 
 def asPhrase(dct):
 	return Phrase(
-		dct['hotstring'], dct['triggers'], dct['type'], dct['body'],
+		dct['hotstring'], dct['triggers'], dct['type'], dct.get('body'),
 		dct['method'], dct['wm_class'], dct['wm_title'], dct['hotkey']
 	)
 
 
-def phraseToDict(phrase):
-	return {
+def phraseToDict(phrase, body=True):
+	dct = {
 		'hotstring': phrase.hotstring,
 		'triggers': phrase.triggers,
 		'type': phrase.type.value,
-		'body': phrase.body,
 		'method': phrase.method.value,
 		'wm_class': phrase.wm_class,
 		'wm_title': phrase.wm_title,
 		'hotkey': (
 			phrase.hotkey[0].name, tuple(mod.name for mod in phrase.hotkey[1])
-		),
+		) if phrase.hotkey else None,
 	}
+	if body:
+		dct['body'] = phrase.body
+	return dct
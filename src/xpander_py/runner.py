@@ -0,0 +1,128 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from subprocess import run as spawn, PIPE, TimeoutExpired
+from shlex import split as shlexSplit
+from threading import Lock
+from traceback import format_tb
+from .server import Server
+
+
+class Runner(object):
+	pool = None
+	workers = 4
+	timeout = 1.0
+	ttl = 0.0
+	limit = 30.0
+	cache = {}
+	prefetched = {}
+	pending = {}
+	lock = Lock()
+
+	@classmethod
+	def configure(cls, workers, timeout, ttl, limit):
+		with cls.lock:
+			if cls.pool is not None and workers != cls.workers:
+				cls.pool.shutdown(wait=False)
+				cls.pool = None
+			cls.workers = workers
+			cls.timeout = timeout
+			cls.ttl = ttl
+			cls.limit = limit
+
+	@classmethod
+	def execute(cls, command, dir, shell):
+		try:
+			proc = spawn(
+				command if shell else shlexSplit(command),
+				cwd=dir,
+				shell=shell,
+				timeout=cls.limit,
+				text=True,
+				stdout=PIPE,
+				stderr=PIPE,
+			)
+			return proc.stdout.strip(), proc.stderr.strip()
+		except (OSError, ValueError, TimeoutExpired) as e:
+			Server.sendError({
+				'type': 'run',
+				'message': 'Error running command {}'.format(command),
+				'error': repr(e),
+				'traceback': format_tb(e.__traceback__),
+			})
+			return '', ''
+
+	@classmethod
+	def submit(cls, command, dir=None, shell=False, ttl=None, prefetch=False):
+		key = (command, dir, shell)
+		ttl = cls.ttl if ttl is None else ttl
+		with cls.lock:
+			cached = cls.cache.get(key)
+			if cached and cached[0] > time.monotonic():
+				return cached[1]
+			if not prefetch and key in cls.prefetched:
+				expires, result = cls.prefetched.pop(key)
+				if expires > time.monotonic():
+					return result
+			future = cls.pending.get(key)
+			if future is None:
+				if cls.pool is None:
+					cls.pool = ThreadPoolExecutor(
+						max_workers=cls.workers, thread_name_prefix='xpander run'
+					)
+				future = cls.pool.submit(cls.execute, command, dir, shell)
+				future.claimed = not prefetch
+				future.ttl = ttl
+				cls.pending[key] = future
+				future.add_done_callback(lambda future: cls.complete(key, future))
+			else:
+				future.claimed = future.claimed or not prefetch
+				future.ttl = max(future.ttl, ttl)
+			return future
+
+	@classmethod
+	def complete(cls, key, future):
+		with cls.lock:
+			if cls.pending.get(key) is future:
+				del cls.pending[key]
+			if future.cancelled():
+				return
+			if future.ttl > 0:
+				cls.cache[key] = (time.monotonic() + future.ttl, future.result())
+			elif not future.claimed:
+				# Nobody waited for a prefetch yet, hold it briefly for the
+				# run() of the expansion that asked, a skipped branch or a
+				# cancelled expansion must not hand it to a later one
+				now = time.monotonic()
+				for other, (expires, result) in tuple(cls.prefetched.items()):
+					if expires <= now:
+						del cls.prefetched[other]
+				cls.prefetched[key] = (now + cls.timeout, future.result())
+
+	@classmethod
+	def run(
+		cls, command, dir=None, shell=False, stderr=False, timeout=None,
+		ttl=None):
+		result = cls.submit(command, dir, shell, ttl)
+		if not isinstance(result, tuple):
+			try:
+				result = result.result(cls.timeout if timeout is None else timeout)
+			except TimeoutError as e:
+				# Keep running in the background so a ttl can cache the result
+				Server.sendError({
+					'type': 'run',
+					'message': 'Command {} timed out'.format(command),
+					'error': repr(e),
+					'traceback': format_tb(e.__traceback__),
+				})
+				return ''
+		return result[1] if stderr else result[0]
+
+	@classmethod
+	def prefetch(cls, command, dir=None, shell=False, ttl=None):
+		cls.submit(command, dir, shell, ttl, True)
+
+	@classmethod
+	def clear(cls):
+		with cls.lock:
+			cls.cache.clear()
+			cls.prefetched.clear()
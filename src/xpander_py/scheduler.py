@@ -0,0 +1,102 @@
+import heapq
+from itertools import count
+from collections import namedtuple
+from threading import Condition
+
+
+URGENT = 0
+NORMAL = 1
+# Handed out with each item, the scheduler is told when it's done
+Ticket = namedtuple('Ticket', ('generation', 'key', 'counted'))
+
+
+class Scheduler(object):
+	# Bounded priority queue of expansions that can be cancelled as a whole.
+	# Items count against the limit and their key until done(), so the
+	# bound covers every stage of the pipeline, not only this queue
+
+	def __init__(self, limit=0):
+		super().__init__()
+		self.limit = limit
+		self.condition = Condition()
+		self.heap = []
+		self.keys = {}
+		self.active = 0
+		self.order = count()
+		self.generation = 0
+		self.stats = {'queued': 0, 'coalesced': 0, 'dropped': 0, 'cancelled': {}}
+
+	def put(self, item, priority=NORMAL, key=None):
+		with self.condition:
+			if key is not None and self.keys.get(key):
+				# Still waiting, e.g. an auto repeating hotkey
+				self.stats['coalesced'] += 1
+				return False
+			counted = priority != URGENT
+			if self.limit and counted and self.active >= self.limit:
+				self.stats['dropped'] += 1
+				return False
+			heapq.heappush(
+				self.heap,
+				(priority, next(self.order), self.generation, key, item),
+			)
+			if key is not None:
+				self.keys[key] = self.keys.get(key, 0) + 1
+			if counted:
+				self.active += 1
+			self.stats['queued'] += 1
+			self.condition.notify()
+			return True
+
+	def get(self):
+		with self.condition:
+			while not self.heap:
+				self.condition.wait()
+			priority, order, generation, key, item = heapq.heappop(self.heap)
+			return Ticket(generation, key, priority != URGENT), item
+
+	def done(self, ticket):
+		with self.condition:
+			self.release(ticket.key, ticket.counted)
+
+	def release(self, key, counted):
+		if key is not None:
+			self.keys[key] -= 1
+			if not self.keys[key]:
+				del self.keys[key]
+		if counted:
+			self.active -= 1
+
+	def cancel(self, reason):
+		# Everything queued so far is dropped, later stages check current()
+		with self.condition:
+			kept = []
+			for entry in self.heap:
+				if entry[0] == URGENT:
+					kept.append(entry)
+				else:
+					self.release(entry[3], True)
+			cancelled = len(self.heap) - len(kept)
+			heapq.heapify(kept)
+			self.heap = kept
+			self.generation += 1
+			reasons = self.stats['cancelled']
+			reasons[reason] = reasons.get(reason, 0) + cancelled
+		return cancelled
+
+	def current(self, generation):
+		return generation == self.generation
+
+	def qsize(self):
+		return len(self.heap)
+
+	def metrics(self):
+		with self.condition:
+			return {
+				'queued': self.stats['queued'],
+				'coalesced': self.stats['coalesced'],
+				'dropped': self.stats['dropped'],
+				'active': self.active,
+				'cancelled': dict(self.stats['cancelled']),
+				'limit': self.limit,
+			}
@@ -2,25 +2,99 @@
 
 import sys
 import json
+import atexit
+import asyncio
+from threading import Thread, Condition, Lock, local
+from concurrent.futures import ThreadPoolExecutor
+from traceback import format_tb
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+
+if orjson is not None:
+	def dumps(msg):
+		return orjson.dumps(msg, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+	loads = orjson.loads
+else:
+	dumps = json.dumps
+	loads = json.loads
 
 
 class Server(object):
 	listeners = {}
+	workers = {}
+	request = local()
+	outgoing = []
+	pending = 0
+	limit = 1024 * 1024
+	condition = Condition()
+	writer = None
+	errors = Lock()
 
 	@classmethod
 	def start(cls):
+		asyncio.run(cls.serve())
+
+	@classmethod
+	async def serve(cls):
+		loop = asyncio.get_running_loop()
+		reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='xpander stdin')
+		tasks = set()
 		while True:
-			msg = sys.stdin.readline()
-			msg = json.loads(msg) if msg else {'type': 'none'}
-			cls.callback(msg)
+			line = await loop.run_in_executor(reader, sys.stdin.readline)
+			if not line:
+				break
+			if not line.strip():
+				continue
+			try:
+				msg = loads(line)
+			except ValueError as e:
+				cls.sendError({
+					'type': 'invalidMessage',
+					'message': line,
+					'error': repr(e),
+				})
+				continue
+			task = asyncio.ensure_future(cls.dispatch(loop, msg))
+			tasks.add(task)
+			task.add_done_callback(tasks.discard)
+		if tasks:
+			await asyncio.wait(tasks)
+		cls.flush()
+
+	@classmethod
+	async def dispatch(cls, loop, msg):
+		msgType = msg.get('type')
+		# One worker per message type keeps each type in order without
+		# letting a slow reload hold up everything else
+		if msgType not in cls.workers:
+			cls.workers[msgType] = ThreadPoolExecutor(
+				max_workers=1, thread_name_prefix='xpander {}'.format(msgType)
+			)
+		try:
+			await loop.run_in_executor(cls.workers[msgType], cls.callback, msg)
+		except Exception as e:
+			cls.sendError({
+				'type': 'handler',
+				'message': 'Error handling {} message'.format(msgType),
+				'id': msg.get('id'),
+				'error': repr(e),
+				'traceback': format_tb(e.__traceback__),
+			})
 
 	@classmethod
 	def callback(cls, msg):
-		if msg['type'] in cls.listeners:
-			for listener in cls.listeners[msg['type']]:
-				listener(msg)
-		else:
-			cls.sendError({'type': 'unknownMessage', 'message': msg['type']})
+		cls.request.id = msg.get('id')
+		try:
+			if msg['type'] in cls.listeners:
+				for listener in cls.listeners[msg['type']]:
+					listener(msg)
+			else:
+				cls.sendError({'type': 'unknownMessage', 'message': msg['type']})
+		finally:
+			cls.request.id = None
 
 	@classmethod
 	def listen(cls, msgType, callback):
@@ -29,10 +103,56 @@ class Server(object):
 		else:
 			cls.listeners[msgType] = [callback]
 
+	@classmethod
+	def tag(cls, msg):
+		requestId = getattr(cls.request, 'id', None)
+		if requestId is not None and 'id' not in msg:
+			return dict(msg, id=requestId)
+		return msg
+
 	@classmethod
 	def send(cls, msg):
-		print(json.dumps(msg))
+		line = dumps(cls.tag(msg)) + '\n'
+		with cls.condition:
+			if cls.writer is None:
+				cls.writer = Thread(target=cls.write, name='xpander stdout', daemon=True)
+				cls.writer.start()
+				atexit.register(cls.flush)
+			# Backpressure, wait for the front end to catch up
+			while cls.pending > cls.limit and cls.writer is not None:
+				cls.condition.wait()
+			cls.outgoing.append(line)
+			cls.pending += len(line)
+			cls.condition.notify_all()
+
+	@classmethod
+	def write(cls):
+		while True:
+			with cls.condition:
+				while not cls.outgoing:
+					cls.condition.wait()
+				batch = ''.join(cls.outgoing)
+				cls.outgoing.clear()
+			try:
+				sys.stdout.write(batch)
+				sys.stdout.flush()
+			except (OSError, ValueError):
+				with cls.condition:
+					cls.writer = None
+					cls.pending = 0
+					cls.condition.notify_all()
+				return
+			with cls.condition:
+				cls.pending -= len(batch)
+				cls.condition.notify_all()
+
+	@classmethod
+	def flush(cls):
+		with cls.condition:
+			while cls.pending and cls.writer is not None:
+				cls.condition.wait()
 
 	@classmethod
 	def sendError(cls, msg):
-		print(json.dumps(msg), file=sys.stderr)
+		with cls.errors:
+			print(dumps(cls.tag(msg)), file=sys.stderr)
@@ -1,57 +1,134 @@
 import time
-from threading import Thread
+from itertools import count
+from contextlib import nullcontext
+from collections import OrderedDict
+from threading import Thread, Lock
 from queue import Queue
-from macpy import Keyboard, HotString, Key, Platform, PLATFORM, Window
-from markupsafe import Markup
+from concurrent.futures import ThreadPoolExecutor
+from traceback import format_tb
+from macpy import HotString, HotKey, Key, Platform, PLATFORM
 from .server import Server
 from .fs import Settings
 from .output import Output
-from .phrase import PhraseType, PasteMethod
+from .backend import Backend, WindowCache, SelectionCache, Snapshot
 from .context import CONTEXT
+from .runner import Runner
+from .sources import Sources
+from .trace import Trace, record
+from .filters import PhraseIndex
+from .matcher import HotstringMatcher
+from .scheduler import Scheduler, URGENT, NORMAL
+
+
+# Phrases reading these can't render while output owns the clipboard
+SERIAL = {'clipboard', 'primary'}
+# Fill-in dialogs left open without an answer are forgotten past this
+FORMS = 16
 
 
 class Service(Thread):
 
-	def __init__(self):
+	def __init__(self, backend=None):
 		super().__init__(name='xpander service', daemon=True)
+		if backend is not None:
+			Backend.use(backend)
+		self.backend = Backend.get()
 		self.pause = False
 		self.phrases = {}
-		self.queue = Queue()
-		self.keyboard = Keyboard()
-		self.output = Output(self.keyboard)
+		self.triggers = {}
+		self.eventKeys = {}
+		self.queue = Scheduler()
+		self.ready = Queue()
+		self.renderer = None
+		self.renderWorkers = 0
+		self.renders = 0
+		self.lock = Lock()
+		self.forms = OrderedDict()
+		self.formIds = count(1)
+		self.writer = Thread(
+			target=self.deliver, name='xpander output', daemon=True
+		)
+		self.keyboard = self.backend.keyboard
+		self.windows = WindowCache(self.backend)
+		self.windows.onFocus = self.focusChanged
+		self.selections = SelectionCache(self.backend)
+		self.output = Output(self.backend, self.windows, self.selections)
 		self.tabKey = None
 		self.pauseKey = None
 		self.managerKey = None
+		self.abortKey = None
 		self.tabPos = []
+		self.tabCursor = 0
 
-		self.keyboard.install_keyboard_hook(lambda event: None)
+		self.matcher = None
+		if Settings.getBool('match_hotstrings'):
+			self.matcher = HotstringMatcher()
+		self.configure()
+		self.windows.start()
+		self.keyboard.install_keyboard_hook(self.keyHook)
 		self.keyboard.init_hotkeys()
 
+	def configure(self):
+		self.windows.ttl = Settings.getFloat('window_ttl')
+		self.queue.limit = max(0, int(Settings.getFloat('queue_size')))
+		Sources.configure(Settings.getSources())
+		Runner.configure(
+			max(1, int(Settings.getFloat('run_workers'))),
+			Settings.getFloat('run_timeout'),
+			Settings.getFloat('run_ttl'),
+			Settings.getFloat('run_limit'),
+		)
+		workers = max(1, int(Settings.getFloat('render_workers')))
+		if workers != self.renderWorkers:
+			# Swapped before the old one stops taking jobs from the dispatcher
+			previous = self.renderer
+			self.renderer = ThreadPoolExecutor(
+				max_workers=workers, thread_name_prefix='xpander render'
+			)
+			self.renderWorkers = workers
+			if previous is not None:
+				previous.shutdown(wait=False)
+
 	def registerPhrase(self, phrase):
+		events = []
 		if phrase.hotstring:
-			triggers = phrase.triggers
-			hotstring = self.keyboard.register_hotstring(
-				phrase.hotstring, triggers, self.callback
-			)
-			self.phrases[hotstring] = phrase
+			events.append(self.addTrigger(
+				# Keyed like macpy compares events, triggers are unordered
+				('hotstring', phrase.hotstring, frozenset(phrase.triggers)), phrase,
+				lambda: (self.matcher or self.keyboard).register_hotstring(
+					phrase.hotstring, phrase.triggers, self.callback
+				),
+			))
 		if phrase.hotkey:
-			hotkey = self.keyboard.register_hotkey(
-				phrase.hotkey[0], phrase.hotkey[1], self.callback
-			)
-			self.phrases[hotkey] = phrase
-		if phrase.hotstring and phrase.hotkey:
-			phrase.events = (hotstring, hotkey)
-		elif phrase.hotstring:
-			phrase.events = (hotstring, )
-		elif phrase.hotkey:
-			phrase.events = (hotkey, )
+			events.append(self.addTrigger(
+				('hotkey', phrase.hotkey[0], frozenset(phrase.hotkey[1])), phrase,
+				lambda: self.keyboard.register_hotkey(
+					phrase.hotkey[0], phrase.hotkey[1], self.callback
+				),
+			))
+		phrase.events = tuple(events)
+
+	def addTrigger(self, key, phrase, register):
+		event = self.triggers.get(key)
+		if event is None:
+			event = self.triggers[key] = register()
+			self.eventKeys[event] = key
+			self.phrases[event] = PhraseIndex()
+		self.phrases[event].add(phrase)
+		return event
 
 	def unregisterPhrase(self, phrase):
 		for event in phrase.events:
-			if (event) in self.phrases:
-				del self.phrases[event]
+			index = self.phrases.get(event)
+			if index is None:
+				continue
+			index.remove(phrase)
+			if index:
+				continue
+			del self.phrases[event]
+			self.triggers.pop(self.eventKeys.pop(event, None), None)
 			if isinstance(event, HotString):
-				self.keyboard.unregister_hotstring(event)
+				(self.matcher or self.keyboard).unregister_hotstring(event)
 			else:
 				self.keyboard.unregister_hotkey(event)
 		phrase.events = ()
@@ -71,6 +148,11 @@ class Service(Thread):
 			self.managerKey = self.keyboard.register_hotkey(
 				*managerKey, self.callback
 			)
+		abortKey = Settings.getHotkey('abort')
+		if abortKey:
+			self.abortKey = self.keyboard.register_hotkey(
+				*abortKey, self.callback
+			)
 
 	def unregisterHotkeys(self):
 		if self.tabKey:
@@ -79,15 +161,22 @@ class Service(Thread):
 			self.keyboard.unregister_hotkey(self.pauseKey)
 		if self.managerKey:
 			self.keyboard.unregister_hotkey(self.managerKey)
+		if self.abortKey:
+			self.keyboard.unregister_hotkey(self.abortKey)
+
+	def keyHook(self, event):
+		if self.matcher:
+			self.matcher.hook(event)
 
 	def callback(self, event):
-		try:
-			phrase = self.phrases[event]
-			self.enqueue(phrase, event)
-		except KeyError:
+		if event in self.phrases:
+			self.enqueue(None, event)
+		else:
 			if event == self.tabKey and PLATFORM is not Platform.WAYLAND:
 				if self.tabPos:
-					self.output.forward(self.tabPos.pop())
+					position = self.tabPos.pop()
+					self.output.forward(position - self.tabCursor)
+					self.tabCursor = position
 				else:
 					self.output.tab()
 			elif event == self.pauseKey:
@@ -102,6 +191,8 @@ class Service(Thread):
 					'type': 'manager',
 					'action': 'show',
 				})
+			elif event == self.abortKey:
+				self.queue.cancel('abort')
 			else:
 				Server.sendError({
 					'type': 'event',
@@ -109,109 +200,218 @@ class Service(Thread):
 					'event': str(event),
 				})
 
-	def enqueue(self, phrase, event):
-		self.queue.put_nowait((phrase, event))
+	def enqueue(self, phrase, event, priority=NORMAL):
+		if phrase is None and event is None:
+			# Stopping doesn't wait for queued expansions
+			priority = URGENT
+		# Hotkeys left nothing to erase, repeats can be merged safely
+		key = event if phrase is None and isinstance(event, HotKey) else None
+		self.queue.put((phrase, event, time.perf_counter()), priority, key)
+
+	def focusChanged(self, window):
+		if Settings.getBool('cancel_on_focus'):
+			self.queue.cancel('focus')
+
+	def depth(self):
+		return {
+			'input': self.queue.qsize(),
+			'render': self.renders,
+			'output': self.ready.qsize(),
+			'scheduler': self.queue.metrics(),
+		}
 
 	def run(self):
+		self.writer.start()
+		while True:
+			ticket, (phrase, event, queued) = self.queue.get()
+			if phrase is None and event is None:
+				self.ready.put(None)
+				break
+			try:
+				self.dispatch(ticket, phrase, event, queued)
+			except Exception as e:
+				# The ticket never reached the output stage, nothing else frees it
+				self.queue.done(ticket)
+				Server.sendError({
+					'type': 'dispatch',
+					'message': 'Error dispatching expansion',
+					'error': repr(e),
+					'traceback': format_tb(e.__traceback__),
+				})
+
+	def dispatch(self, ticket, phrase, event, queued):
+		trace = Trace(phrase, event, queued)
+		trace.lap('queue')
+		if not self.pause and phrase is None:
+			phrase = self.select(event)
+		trace.wm_class = self.windows.wmClass
+		trace.lap('filter')
+		if self.pause or phrase is None:
+			self.queue.done(ticket)
+			return
+		trace.describe(phrase)
+		job = None
+		if not phrase.uses(SERIAL):
+			with self.lock:
+				self.renders += 1
+			try:
+				job = self.renderer.submit(self.render, phrase, True)
+			except RuntimeError:
+				# Pool shut down by configure(), render in the output stage
+				with self.lock:
+					self.renders -= 1
+		self.ready.put((
+			self.expand, (phrase, event, trace, job, ticket.generation), ticket,
+		))
+
+	def render(self, phrase, pooled=False, snapshot=None):
+		start = time.perf_counter()
+		try:
+			with snapshot or nullcontext():
+				return phrase.instructions(CONTEXT), time.perf_counter() - start
+		finally:
+			if pooled:
+				with self.lock:
+					self.renders -= 1
 
+	def deliver(self):
+		# Expansions and fill-in answers alike, output happens only here
 		while True:
-			phrase, event = self.queue.get()
-			if phrase is None:
+			item = self.ready.get()
+			if item is None:
 				break
-			if (
-				not self.pause
-				and self.filterWindows(phrase.wm_class, phrase.wm_title)
-			):
-				if phrase.hotstring:
-					self.output.backspace(
-						len(phrase.hotstring)
-						+ (1 if getattr(event, 'trigger', '') else 0)
-					)
-				body = phrase.render(CONTEXT)
-				keepTrig = Settings.getBool('keep_trig')
-				if (keepTrig and getattr(event, 'trigger', '')):
-					trigger = getattr(event, 'trigger', '')
-				else:
-					trigger = ''
-				if '$+' in body and getattr(event, 'trigger', ''):
-					body = body.replace('$+', '')
-					trigger = getattr(event, 'trigger', '')
-				elif '$-' in body:
-					body = body.replace('$-', '')
-					trigger = ''
-				if 'class="xpander-fillin"' in body:
-					Server.send({
-						'type': 'phrase',
-						'action': 'fillin',
-						'body': body,
-						'method': phrase.method.value,
-						'trigger': trigger,
-						'richText': True if phrase.type is PhraseType.RICHTEXT else False,  # noqa
-					})
-				else:
-					if phrase.type is PhraseType.RICHTEXT:
-						richText = body
-						body = Markup(body).striptags()
-					else:
-						richText = None
-					if '$|' in body:
-						body, richText = self.getTabStops(body, richText)
-					self.output.send(
-						phrase.method,
-						body + trigger,
-						(richText + trigger) if richText else None,
-					)
-					if self.tabPos:
-						self.output.backward(
-							len(body + trigger) - self.tabPos.pop()
-						)
-						if not Settings.getBool('use_tab'):
-							self.tabPos.clear()
-
-	def fillin(self, phrase):
-		time.sleep(0.05)
-		if phrase['richText']:
-			richText = phrase['body']
-			plainText = Markup(phrase['body']).striptags()
+			handler, args, ticket = item
+			try:
+				handler(*args)
+			except Exception as e:
+				Server.sendError({
+					'type': 'output',
+					'message': 'Error writing output',
+					'error': repr(e),
+					'traceback': format_tb(e.__traceback__),
+				})
+			finally:
+				if ticket is not None:
+					self.queue.done(ticket)
+
+	def expand(self, phrase, event, trace, job, generation):
+		trace.lap('dispatch')
+		if not self.queue.current(generation):
+			trace.details['cancelled'] = True
+			record(trace)
+			return
+		if phrase.hotstring:
+			self.output.backspace(
+				len(phrase.hotstring)
+				+ (1 if getattr(event, 'trigger', '') else 0)
+			)
+		trace.lap('backspace')
+		try:
+			snapshot = Snapshot(self.selections)
+			if job:
+				instructions, elapsed = job.result()
+			else:
+				instructions, elapsed = self.render(phrase, snapshot=snapshot)
+		except Exception as e:
+			Server.sendError({
+				'type': 'render',
+				'message': 'Error rendering phrase {}'.format(phrase.name),
+				'error': repr(e),
+				'traceback': format_tb(e.__traceback__),
+			})
+			return
+		trace.lap('render')
+		if not self.queue.current(generation):
+			trace.details['cancelled'] = True
+			record(trace)
+			return
+		trace.details['render'] = elapsed
+		trace.details['depth'] = self.depth()
+		eventTrigger = getattr(event, 'trigger', '') or ''
+		trigger = eventTrigger if Settings.getBool('keep_trig') else ''
+		if instructions.keep and eventTrigger:
+			trigger = eventTrigger
+		elif instructions.drop:
+			trigger = ''
+		if instructions.fillin is not None:
+			trace.details['fillin'] = True
+			formId = next(self.formIds)
+			with self.lock:
+				self.forms[formId] = (instructions.fillin, phrase.method, trigger)
+				while len(self.forms) > FORMS:
+					self.forms.popitem(last=False)
+			Server.send(dict(
+				instructions.fillin.schema(),
+				type='phrase',
+				action='fillin',
+				form=formId,
+			))
 		else:
-			richText = None
-			plainText = phrase['body']
-		self.output.send(
-			PasteMethod(phrase['method']),
-			plainText + phrase['trigger'],
-			(richText + phrase['trigger']) if richText else None,
-		)
-		if self.tabPos:
+			self.output.watch = None
+			self.execute(
+				phrase.method, instructions, trigger, trace, snapshot, generation
+			)
+			if self.output.watch:
+				trace.details['clipboard'] = self.output.watch.phases
+			trace.details['length'] = instructions.length + len(trigger)
+		record(trace)
+
+	def execute(
+		self, method, instructions, trigger, trace=None, snapshot=None,
+		generation=None,
+	):
+		self.tabPos = list(reversed(instructions.tabStops))
+		self.tabCursor = 0
+		if trace:
+			trace.lap('tabstops')
+
+		def cancelled():
+			return generation is not None and not self.queue.current(generation)
+
+		self.output.execute(method, instructions, trigger, snapshot, cancelled)
+		if trace:
+			trace.lap('output')
+		if cancelled():
+			# Tab stops point into text that was never written
+			self.tabPos.clear()
+			if trace:
+				trace.details['cancelled'] = True
+		elif self.tabPos:
+			self.tabCursor = self.tabPos.pop()
 			self.output.backward(
-				len(plainText + phrase['trigger']) - self.tabPos.pop()
+				instructions.length + len(trigger) - self.tabCursor
 			)
+			if not Settings.getBool('use_tab'):
+				self.tabPos.clear()
+		if trace:
+			trace.lap('cursor')
 
-	def getTabStops(self, plainText, richText):
-		self.tabPos = []
-		richText = richText.replace('$|', '') if richText else None
-		for i in range(plainText.count('$|')):
-			self.tabPos.append(plainText.index('$|'))
-			plainText = plainText.replace('$|', '', 1)
-		self.tabPos.reverse()
-		return plainText, richText
-
-	def filterWindows(self, wm_class, wm_title):
+	def fillin(self, form, values):
+		with self.lock:
+			pending = self.forms.pop(form, None)
+		if pending is None or values is None:
+			return
+		self.ready.put((self.answer, pending + (values, ), None))
+
+	def answer(self, form, method, trigger, values):
+		time.sleep(0.05)
+		self.execute(method, form.instructions(values), trigger)
+
+	def select(self, event):
+		index = self.phrases.get(event)
+		if index is None:
+			return None
 		if PLATFORM is Platform.WAYLAND:
-			return True
-		expand = False
-		window = Window.get_active()
-		if window.wm_class in wm_class or not wm_class:
-			expand = True
-		if wm_title:
-			if wm_title in window.title:
-				expand = True
-			else:
-				expand = False
-		return expand
+			return index.fallback()
+		return index.select(
+			self.windows.activeClass(), self.windows.activeTitle
+		)
 
 	def quit(self):
-		self.keyboard.close()
-		self.output.quit()
+		try:
+			self.windows.stop()
+		finally:
+			self.backend.close()
 
 	def togglePause(self, state=None):
 		if state is not None:
@@ -220,3 +420,5 @@ class Service(Thread):
 		else:
 			self.pause = not self.pause
 			Server.send({'type': 'main', 'action': 'pause', 'state': self.pause})
+		if self.pause:
+			self.queue.cancel('pause')
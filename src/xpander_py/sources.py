@@ -0,0 +1,434 @@
+import csv
+import json
+import os
+import time
+import sqlite3
+from pathlib import Path
+from threading import Thread, Lock, Event
+from subprocess import run as spawn, PIPE
+from shlex import split as shlexSplit
+from urllib.parse import quote
+from urllib.request import urlopen
+from io import StringIO
+from traceback import format_tb
+from .server import Server
+
+
+class Lines(object):
+	# Feeds csv.reader from a binary file while tracking record offsets
+
+	def __init__(self, fd, encoding):
+		super().__init__()
+		self.fd = fd
+		self.encoding = encoding
+		self.position = fd.tell()
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		line = self.fd.readline()
+		if not line:
+			raise StopIteration
+		self.position = self.fd.tell()
+		return line.decode(self.encoding)
+
+
+class Source(object):
+
+	def __init__(self, name, spec):
+		super().__init__()
+		self.name = name
+		self.spec = spec
+		self.ttl = float(spec.get('ttl', 60))
+		self.key = spec.get('key')
+		self.lock = Lock()
+		self.reloading = Lock()
+		self.loaded = None
+		self.cache = {}
+
+	def stale(self):
+		return self.loaded is None or time.monotonic() - self.loaded > self.ttl
+
+	def refresh(self, force=False):
+		if force or self.stale():
+			# Lookups wait for a reload in progress instead of reading half of it
+			with self.reloading:
+				if force or self.stale():
+					self.reload()
+
+	def reload(self):
+		self.load()
+		self.loaded = time.monotonic()
+
+	def load(self):
+		with self.lock:
+			self.cache.clear()
+
+	def cached(self, key, fetch):
+		self.refresh()
+		now = time.monotonic()
+		with self.lock:
+			entry = self.cache.get(key)
+		if entry and now - entry[0] <= self.ttl:
+			return entry[1]
+		value = fetch(key)
+		with self.lock:
+			self.cache[key] = (now, value)
+		return value
+
+	def lookup(self, key):
+		return None
+
+	def rows(self):
+		return []
+
+	def close(self):
+		pass
+
+
+class RowsSource(Source):
+	# Small sources held in memory and indexed by key
+
+	def __init__(self, name, spec):
+		super().__init__(name, spec)
+		self.data = []
+		self.index = {}
+
+	def load(self):
+		data = self.fetch()
+		if isinstance(data, dict):
+			index = {str(key): row for key, row in data.items()}
+			data = list(data.values())
+		else:
+			data = list(data)
+			index = {}
+			if self.key:
+				for row in data:
+					if isinstance(row, dict) and self.key in row:
+						index.setdefault(str(row[self.key]), row)
+		with self.lock:
+			self.data = data
+			self.index = index
+
+	def fetch(self):
+		return []
+
+	def lookup(self, key):
+		self.refresh()
+		return self.index.get(str(key))
+
+	def rows(self):
+		self.refresh()
+		return self.data
+
+
+class FileSource(Source):
+
+	def __init__(self, name, spec):
+		super().__init__(name, spec)
+		self.path = Path(spec['path']).expanduser()
+		self.encoding = spec.get('encoding', 'utf-8')
+		self.stamp = None
+
+	def stale(self):
+		if self.loaded is None:
+			return True
+		if time.monotonic() - self.loaded <= self.ttl:
+			return False
+		try:
+			stat = self.path.stat()
+		except OSError:
+			return self.stamp is not None
+		if (stat.st_mtime_ns, stat.st_size) == self.stamp:
+			# Unchanged, check again after another ttl
+			self.loaded = time.monotonic()
+			return False
+		return True
+
+	def reload(self):
+		try:
+			stat = self.path.stat()
+			self.stamp = (stat.st_mtime_ns, stat.st_size)
+		except OSError:
+			self.stamp = None
+		super().reload()
+
+
+class IndexedSource(FileSource):
+	# Large files stay on disk, only record offsets are kept in memory.
+	# Records are read through an open file rather than a memory map,
+	# a file rewritten in place would crash the process through a map
+
+	def __init__(self, name, spec):
+		super().__init__(name, spec)
+		self.fd = None
+		self.offsets = {}
+		self.header = None
+
+	def load(self):
+		fd = None
+		offsets = {}
+		header = None
+		if self.stamp and self.stamp[1]:
+			fd = self.path.open('rb')
+			header, offsets = self.scan(fd)
+		with self.lock:
+			self.close()
+			self.fd = fd
+			self.offsets = offsets
+			self.header = header
+
+	def changed(self):
+		# Offsets are only valid for the contents they were read from
+		if self.fd is None:
+			return False
+		stat = os.fstat(self.fd.fileno())
+		return (stat.st_mtime_ns, stat.st_size) != self.stamp
+
+	def lookup(self, key):
+		self.refresh()
+		if self.changed():
+			self.refresh(True)
+		with self.lock:
+			offset = self.offsets.get(str(key))
+			if offset is None:
+				return None
+			return self.read(self.fd, offset)
+
+	def rows(self):
+		self.refresh()
+		if self.changed():
+			self.refresh(True)
+		with self.lock:
+			if self.fd is None:
+				return []
+			return [self.read(self.fd, offset) for offset in self.offsets.values()]
+
+	def close(self):
+		if self.fd is not None:
+			self.fd.close()
+			self.fd = None
+
+
+class CsvSource(IndexedSource):
+
+	def scan(self, fd):
+		fd.seek(0)
+		lines = Lines(fd, self.encoding)
+		reader = csv.reader(lines, delimiter=self.spec.get('delimiter', ','))
+		header = next(reader, None)
+		if header is None:
+			return None, {}
+		column = header.index(self.key) if self.key in header else 0
+		offsets = {}
+		start = lines.position
+		for row in reader:
+			if len(row) > column:
+				offsets.setdefault(row[column], start)
+			start = lines.position
+		return header, offsets
+
+	def read(self, fd, offset):
+		fd.seek(offset)
+		reader = csv.reader(
+			Lines(fd, self.encoding), delimiter=self.spec.get('delimiter', ',')
+		)
+		return dict(zip(self.header, next(reader, ())))
+
+
+class JsonLinesSource(IndexedSource):
+
+	def scan(self, fd):
+		fd.seek(0)
+		offsets = {}
+		start = 0
+		for line in iter(fd.readline, b''):
+			if line.strip():
+				row = json.loads(line)
+				if isinstance(row, dict) and self.key in row:
+					offsets.setdefault(str(row[self.key]), start)
+			start = fd.tell()
+		return None, offsets
+
+	def read(self, fd, offset):
+		fd.seek(offset)
+		return json.loads(fd.readline())
+
+
+class JsonSource(FileSource, RowsSource):
+
+	def fetch(self):
+		if self.stamp is None:
+			return []
+		return json.loads(self.path.read_text(encoding=self.encoding))
+
+
+class SqliteSource(Source):
+
+	def lookup(self, key):
+		return self.cached(key, self.query)
+
+	def connect(self):
+		path = Path(self.spec['path']).expanduser()
+		return sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+
+	def query(self, key):
+		connection = self.connect()
+		try:
+			connection.row_factory = sqlite3.Row
+			row = connection.execute(self.spec['query'], (key, )).fetchone()
+			return dict(row) if row is not None else None
+		finally:
+			connection.close()
+
+	def rows(self):
+		connection = self.connect()
+		try:
+			connection.row_factory = sqlite3.Row
+			return [dict(row) for row in connection.execute(self.spec['rows'])]
+		finally:
+			connection.close()
+
+
+def decode(text, form):
+	if form == 'csv':
+		return list(csv.DictReader(StringIO(text)))
+	if form == 'lines':
+		return text.splitlines()
+	return json.loads(text)
+
+
+class HttpSource(RowsSource):
+
+	def request(self, url):
+		with urlopen(url, timeout=float(self.spec.get('timeout', 2))) as response:
+			return decode(response.read().decode('utf-8'), self.spec.get('format'))
+
+	def fetch(self):
+		if '{key}' in self.spec['url']:
+			return []
+		return self.request(self.spec['url'])
+
+	def lookup(self, key):
+		if '{key}' in self.spec['url']:
+			return self.cached(key, lambda key: self.request(
+				self.spec['url'].format(key=quote(str(key), safe=''))
+			))
+		return super().lookup(key)
+
+
+class CommandSource(RowsSource):
+
+	def fetch(self):
+		command = self.spec['command']
+		shell = self.spec.get('shell', False)
+		proc = spawn(
+			command if shell else shlexSplit(command),
+			cwd=self.spec.get('dir'),
+			shell=shell,
+			timeout=float(self.spec.get('timeout', 10)),
+			text=True,
+			stdout=PIPE,
+			stderr=PIPE,
+		)
+		return decode(proc.stdout, self.spec.get('format'))
+
+
+TYPES = {
+	'csv': CsvSource,
+	'jsonl': JsonLinesSource,
+	'json': JsonSource,
+	'sqlite': SqliteSource,
+	'http': HttpSource,
+	'command': CommandSource,
+}
+
+
+class Sources(object):
+	sources = {}
+	thread = None
+	wake = Event()
+	interval = 1.0
+	reported = set()
+	lock = Lock()
+
+	@classmethod
+	def configure(cls, specs):
+		sources = {}
+		with cls.lock:
+			cls.reported.clear()
+		for name, spec in specs.items():
+			try:
+				if isinstance(spec, str):
+					spec = json.loads(spec)
+				current = cls.sources.get(name)
+				if current is not None and current.spec == spec:
+					sources[name] = current
+					continue
+				sources[name] = TYPES[spec['type']](name, spec)
+			except Exception as e:
+				cls.error(name, e)
+		for name, source in cls.sources.items():
+			if sources.get(name) is not source:
+				source.close()
+		cls.sources = sources
+		if sources and cls.thread is None:
+			cls.thread = Thread(target=cls.refresher, name='xpander sources', daemon=True)
+			cls.thread.start()
+		cls.wake.set()
+
+	@classmethod
+	def get(cls, name):
+		return cls.sources.get(name)
+
+	@classmethod
+	def lookup(cls, name, key):
+		source = cls.sources.get(name)
+		if source is None:
+			return None
+		try:
+			return source.lookup(key)
+		except Exception as e:
+			# A source that's down shouldn't take the expansion with it
+			cls.error(name, e)
+			return None
+
+	@classmethod
+	def rows(cls, name):
+		source = cls.sources.get(name)
+		if source is None:
+			return []
+		try:
+			return source.rows()
+		except Exception as e:
+			cls.error(name, e)
+			return []
+
+	@classmethod
+	def refresher(cls):
+		# Keep sources warm so expansions rarely wait for a reload
+		while True:
+			for source in tuple(cls.sources.values()):
+				try:
+					if source.stale():
+						source.refresh()
+				except Exception as e:
+					source.loaded = time.monotonic()
+					cls.error(source.name, e)
+			cls.wake.wait(cls.interval)
+			cls.wake.clear()
+
+	@classmethod
+	def error(cls, name, e):
+		# Once per source and error, lookups and the refresher retry often
+		with cls.lock:
+			if (name, repr(e)) in cls.reported:
+				return
+			cls.reported.add((name, repr(e)))
+		Server.sendError({
+			'type': 'source',
+			'message': 'Error loading data source {}'.format(name),
+			'error': repr(e),
+			'traceback': format_tb(e.__traceback__),
+		})
@@ -0,0 +1,129 @@
+import re
+from hashlib import sha1
+from collections import namedtuple, OrderedDict
+from weakref import WeakValueDictionary
+from threading import Lock
+from jinja2 import Environment, FileSystemBytecodeCache, nodes
+from jinja2.exceptions import TemplateError
+
+
+ENV = Environment()
+TEMPLATES = WeakValueDictionary()
+# Phrases only hold a key, these keep recently used templates alive
+RECENT = OrderedDict()
+RECENT_SIZE = 512
+DELIMITERS = ('{{', '{%', '{#')
+NEWLINES = re.compile(r'\r\n|\r|\n')
+# Template names whose output can change between renders
+VOLATILE = {
+	'time', 'clipboard', 'primary', 'run', 'prefetch', 'lookup', 'rows', 'lipsum',
+}
+VOLATILE_FILTERS = {'random'}
+LOCK = Lock()
+STATS = {
+	'compiled': 0,
+	'cached': 0,
+}
+
+
+def useCache(directory):
+	directory.mkdir(parents=True, exist_ok=True)
+	ENV.bytecode_cache = FileSystemBytecodeCache(str(directory))
+
+
+def bodyHash(body):
+	return sha1(body.encode('utf-8')).hexdigest()
+
+
+def isStatic(body):
+	return not any(delimiter in body for delimiter in DELIMITERS)
+
+
+def staticText(body):
+	# What rendering a template without any Jinja syntax would produce
+	text = NEWLINES.sub(ENV.newline_sequence, body)
+	if not ENV.keep_trailing_newline and text.endswith(ENV.newline_sequence):
+		text = text[:-len(ENV.newline_sequence)]
+	return text
+
+
+Analysis = namedtuple(
+	'Analysis', ('static', 'names', 'phrases', 'volatile', 'dynamic')
+)
+# Every phrase without Jinja syntax shares this one
+STATIC = Analysis(True, frozenset(), frozenset(), False, False)
+
+
+def analyze(body):
+	if isStatic(body):
+		return STATIC
+	try:
+		ast = ENV.parse(body)
+	except TemplateError:
+		return Analysis(False, frozenset(), frozenset(), True, True)
+	names = frozenset(
+		node.name for node in ast.find_all(nodes.Name) if node.ctx == 'load'
+	)
+	volatile = bool(names & VOLATILE)
+	phrases = set()
+	dynamic = False
+	for call in ast.find_all(nodes.Call):
+		if not isinstance(call.node, nodes.Name):
+			continue
+		if call.node.name == 'phrase':
+			if call.args and isinstance(call.args[0], nodes.Const):
+				phrases.add(call.args[0].value)
+			else:
+				# Can't tell which phrase is referenced
+				volatile = dynamic = True
+	for node in ast.find_all(nodes.Filter):
+		if node.name in VOLATILE_FILTERS:
+			volatile = True
+	return Analysis(False, names, frozenset(phrases), volatile, dynamic)
+
+
+def keep(key, template):
+	with LOCK:
+		RECENT[key] = template
+		RECENT.move_to_end(key)
+		while len(RECENT) > RECENT_SIZE:
+			RECENT.popitem(last=False)
+	return template
+
+
+def cachedTemplate(key):
+	template = TEMPLATES.get(key)
+	if template is not None:
+		keep(key, template)
+	return template
+
+
+def compileTemplate(body):
+	key = bodyHash(body)
+	template = cachedTemplate(key)
+	if template is not None:
+		return template
+	code = None
+	bucket = None
+	cache = ENV.bytecode_cache
+	if cache is not None:
+		bucket = cache.get_bucket(ENV, key, None, body)
+		code = bucket.code
+	if code is None:
+		code = ENV.compile(body, key)
+		with LOCK:
+			STATS['compiled'] += 1
+		if bucket is not None:
+			bucket.code = code
+			cache.set_bucket(bucket)
+	else:
+		with LOCK:
+			STATS['cached'] += 1
+	template = ENV.template_class.from_code(ENV, code, ENV.make_globals(None))
+	TEMPLATES[key] = template
+	return keep(key, template)
+
+
+def resetStats():
+	STATS['compiled'] = 0
+	STATS['cached'] = 0
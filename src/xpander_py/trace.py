@@ -0,0 +1,112 @@
+import json
+import time
+from pathlib import Path
+from collections import deque
+from threading import Lock
+from traceback import format_tb
+from .fs import Settings
+from .server import Server
+from .util import Stopwatch
+
+
+TRACES = deque(maxlen=200)
+LOCK = Lock()
+TRACE_FILE = {'path': None, 'fd': None}
+# Setting values already reported as unusable
+FAILED = set()
+
+
+class Trace(Stopwatch):
+
+	def __init__(self, phrase, event, start=None):
+		super().__init__()
+		if start is not None:
+			self.start = self.last = start
+		self.time = time.time()
+		self.phrase = self.path = self.method = None
+		self.trigger = 'hotstring' if hasattr(event, 'trigger') else 'hotkey'
+		self.wm_class = None
+		self.details = {}
+		if phrase is not None:
+			self.describe(phrase)
+
+	def describe(self, phrase):
+		self.phrase = phrase.name
+		self.path = str(phrase.path) if phrase.path else None
+		self.method = phrase.method.value
+
+	def asDict(self):
+		return {
+			'time': self.time,
+			'phrase': self.phrase,
+			'path': self.path,
+			'method': self.method,
+			'trigger': self.trigger,
+			'wm_class': self.wm_class,
+			'total': self.total,
+			'stages': self.phases,
+			**self.details,
+		}
+
+
+def report(option, value, e):
+	# Once per value, tracing must never stop expansions
+	if (option, value) in FAILED:
+		return
+	FAILED.add((option, value))
+	Server.sendError({
+		'type': 'trace',
+		'message': 'Invalid {} setting {}'.format(option, value),
+		'error': repr(e),
+		'traceback': format_tb(e.__traceback__),
+	})
+
+
+def closeFile():
+	if TRACE_FILE['fd']:
+		try:
+			TRACE_FILE['fd'].close()
+		except OSError:
+			pass
+	TRACE_FILE['fd'] = None
+
+
+def record(trace):
+	global TRACES
+	entry = trace.asDict()
+	with LOCK:
+		value = Settings.get('trace_size')
+		try:
+			size = int(value)
+			if TRACES.maxlen != size:
+				TRACES = deque(TRACES, maxlen=size)
+		except ValueError as e:
+			report('trace_size', value, e)
+		TRACES.append(entry)
+		path = Settings.get('trace_file')
+		if path != TRACE_FILE['path']:
+			closeFile()
+			TRACE_FILE['path'] = path
+			if path:
+				try:
+					TRACE_FILE['fd'] = Path(path).expanduser().open(
+						mode='a', buffering=1
+					)
+				except OSError as e:
+					report('trace_file', path, e)
+		if TRACE_FILE['fd']:
+			try:
+				TRACE_FILE['fd'].write(json.dumps(entry) + '\n')
+			except (OSError, ValueError) as e:
+				closeFile()
+				report('trace_file', path, e)
+
+
+def traces():
+	with LOCK:
+		return list(TRACES)
+
+
+def clear():
+	with LOCK:
+		TRACES.clear()
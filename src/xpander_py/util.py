@@ -1,9 +1,28 @@
-from macpy import Window
+import time
 from .server import Server
+from .backend import Backend
 
 
 def listWindows():
 	windowList = []
-	for window in Window.list_windows():
+	for window in Backend.get().listWindows():
 		windowList.append({'class': window.wm_class, 'title': window.title})
 	Server.send({'type': 'manager', 'action': 'listWindows', 'list': windowList})
+
+
+class Stopwatch(object):
+
+	def __init__(self):
+		super().__init__()
+		self.start = self.last = time.perf_counter()
+		self.phases = {}
+
+	def lap(self, phase):
+		now = time.perf_counter()
+		self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+		self.last = now
+		return now
+
+	@property
+	def total(self):
+		return self.last - self.start
@@ -0,0 +1,211 @@
+import os
+import sys
+import time
+import struct
+from select import select
+from threading import Thread
+from traceback import format_tb
+from .server import Server
+if sys.platform.startswith('linux'):
+	from ctypes import CDLL, get_errno
+	from ctypes.util import find_library
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_MASK = (
+	IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+	| IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+EVENT = struct.Struct('iIII')
+
+
+def loadInotify():
+	if not sys.platform.startswith('linux'):
+		return None
+	try:
+		libc = CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+		libc.inotify_init1
+		libc.inotify_add_watch
+		return libc
+	except (OSError, AttributeError):
+		return None
+
+
+class Watcher(Thread):
+
+	def __init__(self, root, callback, delay=0.5, interval=2.0, poll=False):
+		super().__init__(name='xpander watcher', daemon=True)
+		self.root = str(root)
+		self.callback = callback
+		self.delay = delay
+		self.interval = interval
+		self.running = False
+		self.pending = set()
+		self.deadline = None
+		self.libc = None if poll else loadInotify()
+		self.fd = None
+		self.watches = {}
+		self.dirs = {}
+		self.files = {}
+
+	def run(self):
+		self.running = True
+		try:
+			if self.libc is not None and self.initInotify():
+				self.watchInotify()
+			else:
+				self.watchPoll()
+		except Exception as e:
+			Server.sendError({
+				'type': 'watch',
+				'message': 'Phrase directory watcher stopped',
+				'error': repr(e),
+				'traceback': format_tb(e.__traceback__),
+			})
+		finally:
+			if self.fd is not None:
+				os.close(self.fd)
+				self.fd = None
+
+	def stop(self):
+		self.running = False
+
+	def queue(self, path):
+		self.pending.add(path)
+		self.deadline = time.monotonic() + self.delay
+
+	def flush(self):
+		if self.pending and time.monotonic() >= self.deadline:
+			paths = sorted(self.pending)
+			self.pending.clear()
+			self.deadline = None
+			try:
+				self.callback(paths)
+			except Exception as e:
+				Server.sendError({
+					'type': 'watch',
+					'message': 'Error applying phrase directory changes',
+					'error': repr(e),
+					'traceback': format_tb(e.__traceback__),
+				})
+
+	def timeout(self, default):
+		if self.deadline is None:
+			return default
+		return max(0, min(default, self.deadline - time.monotonic()))
+
+	def initInotify(self):
+		fd = self.libc.inotify_init1(os.O_CLOEXEC)
+		if fd < 0:
+			return False
+		self.fd = fd
+		self.addWatches(self.root)
+		return True
+
+	def addWatches(self, directory):
+		for dirpath, dirnames, filenames in os.walk(directory):
+			wd = self.libc.inotify_add_watch(
+				self.fd, os.fsencode(dirpath), IN_MASK
+			)
+			if wd < 0:
+				Server.sendError({
+					'type': 'watch',
+					'message': 'Cannot watch {}'.format(dirpath),
+					'error': os.strerror(get_errno()),
+				})
+			else:
+				self.watches[wd] = dirpath
+
+	def watchInotify(self):
+		while self.running:
+			readable, _, _ = select((self.fd, ), (), (), self.timeout(0.5))
+			if readable:
+				self.readEvents(os.read(self.fd, 64 * 1024))
+			self.flush()
+
+	def readEvents(self, data):
+		offset = 0
+		while offset < len(data):
+			wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+			offset += EVENT.size
+			name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+			offset += length
+			if mask & IN_Q_OVERFLOW:
+				# Events were lost, let the manager reconcile from the root
+				self.queue(self.root)
+				continue
+			directory = self.watches.get(wd)
+			if directory is None:
+				continue
+			if mask & IN_IGNORED:
+				del self.watches[wd]
+				continue
+			if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+				self.queue(directory)
+				continue
+			path = os.path.join(directory, name)
+			if mask & IN_ISDIR:
+				if mask & (IN_CREATE | IN_MOVED_TO):
+					self.addWatches(path)
+				if mask & (IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE):
+					self.queue(path)
+			elif name.endswith('.json') and not mask & IN_CREATE:
+				self.queue(path)
+
+	def scanDir(self, directory):
+		try:
+			stat = os.stat(directory)
+			entries = tuple(os.scandir(directory))
+		except OSError:
+			return
+		self.dirs[directory] = stat.st_mtime_ns
+		for entry in entries:
+			if entry.is_dir():
+				if entry.path not in self.dirs:
+					self.scanDir(entry.path)
+			elif entry.name.endswith('.json') and entry.path not in self.files:
+				stat = entry.stat()
+				self.files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+
+	def watchPoll(self):
+		self.scanDir(self.root)
+		while self.running:
+			time.sleep(self.timeout(self.interval))
+			self.flush()
+			if self.deadline is not None:
+				continue
+			for directory, mtime in tuple(self.dirs.items()):
+				try:
+					changed = os.stat(directory).st_mtime_ns != mtime
+				except OSError:
+					changed = True
+				if not changed:
+					continue
+				known = set(self.files)
+				if os.path.isdir(directory):
+					self.scanDir(directory)
+				else:
+					del self.dirs[directory]
+					self.queue(directory)
+				for path in set(self.files) - known:
+					self.queue(path)
+			for path, fingerprint in tuple(self.files.items()):
+				try:
+					stat = os.stat(path)
+				except OSError:
+					del self.files[path]
+					self.queue(path)
+					continue
+				if (stat.st_mtime_ns, stat.st_size) != fingerprint:
+					self.files[path] = (stat.st_mtime_ns, stat.st_size)
+					self.queue(path)
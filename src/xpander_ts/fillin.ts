@@ -3,6 +3,18 @@ import $ from "jquery";
 import M from "materialize-css";
 
 
+interface Field {
+	id: string;
+	kind: "entry" | "multi" | "choice" | "optional";
+	name?: string;
+	default?: string | null;
+	width?: number;
+	height?: number;
+	choices?: string[];
+	text?: string;
+}
+
+
 const fillinBody = $("#fillin-body");
 const okButton = $("#ok");
 const cancelButton = $("#cancel");
@@ -15,10 +27,63 @@ window.addEventListener("load", () => {
 });
 
 
-ipcRenderer.on("phrase", (event, msg) => {
-	if (fillinBody) {
-		fillinBody.html(msg.body);
+function escape(text: string): string {
+	return $("<div>").text(text).html();
+}
+
+
+function widget(field: Field, occurrence: number): string {
+	let id = `fillin-${field.id}-${occurrence}`;
+	let name = escape(field.name || "");
+	let value = escape(field.default || "");
+	if (field.kind === "entry") {
+		return `<div class="xpander-fillin input-field inline">
+			<input id="${id}" name="${field.id}" type="text" value="${value}" size="${field.width}">
+			<label for="${id}">${name}</label>
+		</div>`;
+	} else if (field.kind === "multi") {
+		return `<div class="xpander-fillin input-field inline">
+			<textarea id="${id}" class="materialize-textarea" name="${field.id}" col="${field.width}" row="${field.height}">${value}</textarea>
+			<label for="${id}">${name}</label>
+		</div>`;
+	} else if (field.kind === "choice") {
+		let options = (field.default ? [`<option selected value="${value}">${value}</option>`] : [])
+			.concat((field.choices || []).map(choice => `<option value="${escape(choice)}">${escape(choice)}</option>`));
+		return `<div class="xpander-fillin input-field inline">
+			<select id="${id}" name="${field.id}">${options.join("\n")}</select>
+			<label for="${id}">${name}</label>
+		</div>`;
 	}
+	return `<div class="xpander-fillin">
+		<label>
+			<input id="${id}" type="checkbox" name="${field.id}" />
+			<span>${escape(field.text || "")}</span>
+		</label>
+	</div>`;
+}
+
+
+function values(fields: Field[]): { [id: string]: string | boolean } {
+	let result: { [id: string]: string | boolean } = {};
+	for (let field of fields) {
+		let input = $(":input").filter(`[name="${field.id}"]`).first();
+		result[field.id] = field.kind === "optional" ? input.prop("checked") : <string>input.val() || "";
+	}
+	return result;
+}
+
+
+ipcRenderer.on("phrase", (event, msg) => {
+	let occurrences: { [index: number]: number } = {};
+	let body = (<(string | number)[]>msg.segments).map(segment => {
+		if (typeof segment === "number") {
+			occurrences[segment] = (occurrences[segment] || 0) + 1;
+			return widget(msg.fields[segment], occurrences[segment]);
+		}
+		return msg.richText ? segment : `<span class="plain">${escape(segment)}</span>`;
+	}).join("");
+	let answered = false;
+	fillinBody.html(body);
 	M.FormSelect.init(document.querySelectorAll("select"), { dropdownOptions: { coverTrigger: false }});
 	M.updateTextFields();
 	$(":input").on("input", function() {
@@ -32,34 +97,25 @@ ipcRenderer.on("phrase", (event, msg) => {
 			M.updateTextFields();
 		}
 	});
-	okButton.on("click", function(event) {
-		$(":input").each(function() {
-			let $this = $(this);
-			if ($this.attr("type") === "checkbox") {
-				if ($this.prop("checked")) {
-					$this.parents(".xpander-fillin").replaceWith(<string>$this.val() || "");
-				} else {
-					$this.parents(".xpander-fillin").replaceWith("");
-				}
-			} else {
-				$this.parents(".xpander-fillin").replaceWith(<string>$this.val() || "");
-			}
-		});
-		ipcRenderer.send("phrase", {
-			"type": "phrase",
-			"action": "fillin",
-			"phrase": {
-				"body": fillinBody.html(),
-				"method": msg.method,
-				"trigger": msg.trigger,
-				"richText": msg.richText,
-			}
-		});
+	function answer(result: { [id: string]: string | boolean } | null) {
+		if (!answered) {
+			answered = true;
+			ipcRenderer.send("phrase", {
+				"type": "phrase",
+				"action": "fillin",
+				"form": msg.form,
+				"values": result,
+			});
+		}
 		window.close();
+	}
+	okButton.on("click", function(event) {
+		answer(values(msg.fields));
 	});
 	cancelButton.on("click", function(event) {
-		window.close();
+		answer(null);
 	});
+	window.addEventListener("beforeunload", () => answer(null));
 	$(document).on("keyup", function(event) {
 		if (event.key === "Enter") {
 			if (this.activeElement?.tagName === "TEXTAREA" && event.ctrlKey) {
@@ -69,7 +125,7 @@ ipcRenderer.on("phrase", (event, msg) => {
 			}
 		}
 		if (event.key === "Esc" || event.key === "Escape") {
-			window.close();
+			answer(null);
 		}
 	});
 });
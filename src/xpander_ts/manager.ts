@@ -426,6 +426,7 @@ function loadSettings() {
 	$("#theme").formSelect({ dropdownOptions: { coverTrigger: false }});
 	$("#pauseKey").val(Settings.HOTKEY.pause ? parseHotkey(JSON.parse(Settings.HOTKEY.pause)) : "");
 	$("#managerKey").val(Settings.HOTKEY.manager ? parseHotkey(JSON.parse(Settings.HOTKEY.manager)) : "");
+	$("#abortKey").val(Settings.HOTKEY.abort ? parseHotkey(JSON.parse(Settings.HOTKEY.abort)) : "");
 	M.updateTextFields();
 }
 
@@ -529,7 +530,7 @@ $(document).ready(() => {
 	resetEditor(textEditor);
 	$("#editor").find(":input").prop("disabled", true);
 
-	$("#hotkey, #pauseKey, #managerKey").on("keydown", function(event) {
+	$("#hotkey, #pauseKey, #managerKey, #abortKey").on("keydown", function(event) {
 		let key = <string>event.originalEvent?.code;
 		if (key !== "Tab") {
 			event.preventDefault();
@@ -616,6 +617,7 @@ $(document).ready(() => {
 		Settings.DEFAULT.light_theme = $("#theme").formSelect("getSelectedValues")[0];
 		Settings.HOTKEY.pause = JSON.stringify(toHotkey($("#pauseKey").val() || ""));
 		Settings.HOTKEY.manager = JSON.stringify(toHotkey($("#managerKey").val() || ""));
+		Settings.HOTKEY.abort = JSON.stringify(toHotkey($("#abortKey").val() || ""));
 		fs.writeFile(path.join(config, 'settings.ini'), ini.stringify(Settings), () => {
 			ipcRenderer.send("settings", { "type": "settings", "action": "reload" });
 		});